@@ -0,0 +1,264 @@
+__author__ = 'aurcioli'
+import asyncio
+import http.client
+import io
+import ssl
+import time
+import urllib.error
+import urllib.parse
+
+from common import ConnectionPool
+from metrics import Metrics
+
+READ_SIZE = 65536
+
+
+class AsyncResponse:
+    # HTTP/1.1 response read from an asyncio stream. The body is pulled with read_chunk() and the
+    # connection goes back to the pool once the last chunk has been read.
+
+    def __init__(self, pool, key, conn, method, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.method = method
+        self.url = url
+        self.status = 0
+        self.reason = ""
+        self.headers = None
+        self.will_close = False
+        self.chunked = False
+        self.length = None
+        self.chunk_left = 0
+        self.done = False
+
+    async def begin(self):
+        reader = self.conn[0]
+        line = await reader.readline()
+        if not line:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        while True:
+            version, status, reason = self._parse_status(line)
+            header_lines = []
+            while True:
+                h = await reader.readline()
+                if h in (b'\r\n', b'\n', b''):
+                    break
+                header_lines.append(h)
+            if status != 100:
+                break
+            line = await reader.readline()
+
+        self.status = status
+        self.reason = reason
+        self.headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+
+        connection = (self.headers.get('connection') or "").lower()
+        self.will_close = version == "HTTP/1.0" or 'close' in connection
+        self.chunked = 'chunked' in (self.headers.get('transfer-encoding') or "").lower()
+        if not self.chunked and self.headers.get('content-length') is not None:
+            self.length = int(self.headers.get('content-length'))
+        if self.method == "HEAD" or status in (204, 304) or self.length == 0:
+            self._finish()
+        elif not self.chunked and self.length is None:
+            # Body is delimited by the server closing the connection
+            self.will_close = True
+
+    def _parse_status(self, line):
+        parts = line.decode('iso-8859-1').rstrip('\r\n').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise http.client.BadStatusLine(line)
+        reason = parts[2] if len(parts) > 2 else ""
+        return parts[0], int(parts[1]), reason
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    async def read_chunk(self):
+        if self.done:
+            return b''
+        reader = self.conn[0]
+        try:
+            if self.chunked:
+                if self.chunk_left == 0:
+                    size_line = await reader.readline()
+                    self.chunk_left = int(size_line.split(b';', 1)[0].strip(), 16)
+                    if self.chunk_left == 0:
+                        # Skip trailers
+                        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                            pass
+                        self._finish()
+                        return b''
+                data = await reader.read(min(self.chunk_left, READ_SIZE))
+                if not data:
+                    raise http.client.IncompleteRead(b'', self.chunk_left)
+                self.chunk_left -= len(data)
+                if self.chunk_left == 0:
+                    await reader.readexactly(2)
+                return data
+            if self.length is not None:
+                data = await reader.read(min(self.length, READ_SIZE))
+                if not data:
+                    raise http.client.IncompleteRead(b'', self.length)
+                self.length -= len(data)
+                if self.length == 0:
+                    self._finish()
+                return data
+            data = await reader.read(READ_SIZE)
+            if not data:
+                self._finish()
+            return data
+        except (asyncio.IncompleteReadError, ValueError) as err:
+            self.close()
+            raise http.client.IncompleteRead(b'') from err
+        except Exception:
+            self.close()
+            raise
+
+    async def read(self):
+        buf = bytearray()
+        while True:
+            data = await self.read_chunk()
+            if not data:
+                return bytes(buf)
+            buf += data
+
+    def _finish(self):
+        self.done = True
+        if self.conn is not None:
+            if self.will_close:
+                self.pool.discard(self.conn)
+            else:
+                self.pool.release(self.key, self.conn)
+            self.conn = None
+
+    def close(self):
+        self.done = True
+        if self.conn is not None:
+            self.pool.discard(self.conn)
+            self.conn = None
+
+
+class AsyncConnectionPool:
+    # asyncio counterpart of ConnectionPool. Only ever used from the thread that runs the event loop.
+    max_idle = ConnectionPool.MAX_IDLE_PER_HOST
+    idle_timeout = ConnectionPool.IDLE_TIMEOUT
+
+    def __init__(self, max_idle=ConnectionPool.MAX_IDLE_PER_HOST, idle_timeout=ConnectionPool.IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.ssl_context = ssl.create_default_context()
+
+    async def _acquire(self, key):
+        now = time.monotonic()
+        pool = self.idle.get(key, [])
+        while pool:
+            conn, last_used = pool.pop()
+            if now - last_used > self.idle_timeout or conn[0].at_eof():
+                self.discard(conn)
+                Metrics.incr("http_connections_evicted")
+            else:
+                Metrics.incr("http_connections_reused")
+                return conn, True
+        return await self._open(key), False
+
+    async def _open(self, key):
+        scheme, host, port = key
+        Metrics.incr("http_connections_opened")
+        if scheme == "https":
+            return await asyncio.open_connection(host, port, ssl=self.ssl_context, server_hostname=host)
+        return await asyncio.open_connection(host, port)
+
+    def release(self, key, conn):
+        pool = self.idle.setdefault(key, [])
+        if len(pool) < self.max_idle:
+            pool.append((conn, time.monotonic()))
+        else:
+            self.discard(conn)
+
+    def discard(self, conn):
+        conn[1].close()
+
+    def clear(self):
+        for pool in self.idle.values():
+            for conn, last_used in pool:
+                self.discard(conn)
+        self.idle = {}
+
+    async def urlopen(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        for i in range(0, ConnectionPool.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            scheme = parts.scheme.lower()
+            port = parts.port or (443 if scheme == "https" else 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or "/"
+            if parts.query:
+                path = path + "?" + parts.query
+
+            response = await self._send(key, method, url, path, body, headers)
+            Metrics.incr("http_requests")
+
+            if response.status in ConnectionPool.REDIRECT_CODES and response.getheader('location'):
+                await response.read()
+                url = urllib.parse.urljoin(url, response.getheader('location'))
+                if response.status == 303 or (response.status in (301, 302) and method == "POST"):
+                    method = "GET"
+                    body = None
+                    headers = {k: v for k, v in headers.items() if k.lower() not in ('content-type', 'content-length')}
+                continue
+
+            if response.status >= 400:
+                error_body = await response.read()
+                Metrics.incr("http_errors_{}".format(response.status))
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(error_body))
+
+            return response
+
+        raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.headers, io.BytesIO(b""))
+
+    async def _send(self, key, method, url, path, body, headers):
+        request = self._format_request(key, method, path, body, headers)
+        conn, reused = await self._acquire(key)
+        try:
+            return await self._exchange(key, conn, method, url, request)
+        except ConnectionPool.STALE_ERRORS:
+            if not reused:
+                raise
+        # The idle connection went away under us, try once more on a fresh one
+        Metrics.incr("http_connections_stale")
+        conn = await self._open(key)
+        return await self._exchange(key, conn, method, url, request)
+
+    async def _exchange(self, key, conn, method, url, request):
+        try:
+            conn[1].write(request)
+            await conn[1].drain()
+            response = AsyncResponse(self, key, conn, method, url)
+            await response.begin()
+            return response
+        except Exception:
+            self.discard(conn)
+            raise
+
+    def _format_request(self, key, method, path, body, headers):
+        scheme, host, port = key
+        lines = ["{} {} HTTP/1.1".format(method, path)]
+        names = [k.lower() for k in headers]
+        if 'host' not in names:
+            default_port = 443 if scheme == "https" else 80
+            lines.append("Host: {}".format(host if port == default_port else "{}:{}".format(host, port)))
+        if 'accept-encoding' not in names:
+            lines.append("Accept-Encoding: identity")
+        if body is not None:
+            if 'content-type' not in names:
+                lines.append("Content-Type: application/x-www-form-urlencoded")
+            lines.append("Content-Length: {}".format(len(body)))
+        for k, v in headers.items():
+            if k.lower() != 'content-length':
+                lines.append("{}: {}".format(k, v))
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode('iso-8859-1')
+        if body:
+            request += body
+        return request
@@ -1,14 +1,19 @@
 import urllib
 from urllib import parse
-import urllib.request
 from urllib import error
-import time
 import os
 import sys
 import datetime
+import email.utils
+import hashlib
+import mmap
 from oi.IO import IO
+from common import ConnectionPool
 import webbrowser
 
+# Keep-alive connections shared by every thread that goes through webrequest
+pool = ConnectionPool.ConnectionPool()
+
 def launch_browser(url):
     IO.put("Attempting to launch {} in a browser.".format(url))
     try:
@@ -81,6 +86,56 @@ def hashfile(file, hasher, blocksize=65536):
     return hasher.hexdigest()
 
 
+DIGESTS = ("md5", "sha1", "sha256")
+
+
+def new_hashers(algorithms=DIGESTS):
+    return [(name, hashlib.new(name)) for name in algorithms]
+
+
+def copy_and_hash(src, dst, algorithms=DIGESTS, blocksize=1048576, hashers=None, written=None):
+    # Writes src to dst and feeds every block to all hashers, so the data is only read once.
+    # Pass hashers that already saw the start of the file to continue an interrupted copy.
+    # written is called with the size of every block once it is written.
+    if hashers is None:
+        hashers = new_hashers(algorithms)
+    buf = src.read(blocksize)
+    while len(buf) > 0:
+        dst.write(buf)
+        if written is not None:
+            written(len(buf))
+        for name, hasher in hashers:
+            hasher.update(buf)
+        buf = src.read(blocksize)
+    return {name: hasher.hexdigest() for name, hasher in hashers}
+
+
+def hashfile_multi(path, algorithms=DIGESTS, blocksize=8388608):
+    hashers = new_hashers(algorithms)
+    update_hashers(path, hashers, blocksize=blocksize)
+    return {name: hasher.hexdigest() for name, hasher in hashers}
+
+
+def update_hashers(path, hashers, length=None, blocksize=8388608):
+    # Feeds the first length bytes of path (all of it by default) to hashers.
+    # hashlib drops the GIL on large updates, so this scales across threads
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if length is not None:
+            size = min(size, length)
+        if size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    for offset in range(0, size, blocksize):
+                        block = view[offset:min(offset + blocksize, size)]
+                        for name, hasher in hashers:
+                            hasher.update(block)
+                        block.release()
+                finally:
+                    view.release()
+
+
 def safefilename(f):
     f = f.replace('\\', '_')
     f = f.replace('/', '_')
@@ -91,8 +146,7 @@ def safefilename(f):
 
 
 def check_for_pause(project):
-    while project.pause_signal:
-        time.sleep(1)
+    project.running.wait()
 
 
 def path_strip(p):
@@ -108,36 +162,36 @@ def path_normalization(p):
     return p.strip()
 
 def pause_project(p):
-    p.pause_signal = 1
+    p.pause()
     print(os.linesep)
 
 
+def configure_connection_pool(max_idle=None, idle_timeout=None):
+    pool.configure(max_idle, idle_timeout)
+
+
 def webrequest(url, headers, http_intercept, data=None, binary=False, return_req=False):
     try:
         headers['user-agent'] = "searchgiant forensic cli"
         if data is None:
             # GET
-            req = urllib.request.Request(url, None, headers)
-            response = urllib.request.urlopen(req)
-            if return_req:
-                return response
-            if binary:
-                return response.read()
-            return response.read().decode('utf-8')
+            response = pool.urlopen("GET", url, None, headers)
         else:
             # POST
-            req = urllib.request.Request(url, data.encode('utf-8'), headers)
-            response = urllib.request.urlopen(req)
-            if return_req:
-                return response
-            if binary:
-                return response.read()
-            return response.read().decode('utf-8')
+            response = pool.urlopen("POST", url, data.encode('utf-8'), headers)
+        if return_req:
+            return response
+        if binary:
+            return response.read()
+        return response.read().decode('utf-8')
 
     except urllib.error.HTTPError as err:
+        # Lets the callback tell which token was rejected
+        err.request_headers = headers
         new_headers = http_intercept(err)
         if new_headers:
-            return webrequest(url, new_headers, http_intercept, data, binary, return_req)
+            # Only what the callback replaced changes, a Range or Content-Type stays
+            return webrequest(url, dict(headers, **new_headers), http_intercept, data, binary, return_req)
         else:
             raise
 
@@ -207,3 +261,16 @@ def utc_get_datetime_as_string():
 
 
 
+
+def parse_timestamp(value):
+    # Epoch seconds of an RFC 3339 (Google) or RFC 2822 (Dropbox) date, None if it can't be parsed
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        pass
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
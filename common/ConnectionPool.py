@@ -0,0 +1,234 @@
+__author__ = 'aurcioli'
+import http.client
+import io
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from metrics import Metrics
+
+MAX_IDLE_PER_HOST = 10
+IDLE_TIMEOUT = 60
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Errors raised when a kept-alive socket was closed by the remote end while it sat in the pool
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, http.client.BadStatusLine,
+                ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+
+class PooledResponse:
+    # Thin wrapper around http.client.HTTPResponse that hands the connection back to the pool
+    # once the body has been read to the end. Closing it early throws the connection away.
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.code = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def _done(self):
+        if self.conn is not None and self.response.isclosed():
+            self.pool.release(self.key, self.conn)
+            self.conn = None
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if not data and amt:
+            self._check_complete()
+        if not data or amt is None:
+            self.response.close()
+        self._done()
+        return data
+
+    def readinto(self, b):
+        n = self.response.readinto(b)
+        if not n and len(b):
+            self._check_complete()
+        self._done()
+        return n
+
+    def _check_complete(self):
+        # http.client quietly returns EOF when the connection drops before Content-Length was reached
+        if self.response.length:
+            missing = self.response.length
+            self.response.close()
+            if self.conn is not None:
+                self.pool.discard(self.conn)
+                self.conn = None
+            raise http.client.IncompleteRead(b'', missing)
+
+    def close(self):
+        if self.conn is not None:
+            if self.response.isclosed():
+                self.pool.release(self.key, self.conn)
+            else:
+                self.response.close()
+                self.pool.discard(self.conn)
+            self.conn = None
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ConnectionPool:
+    max_idle = MAX_IDLE_PER_HOST
+    idle_timeout = IDLE_TIMEOUT
+
+    def __init__(self, max_idle=MAX_IDLE_PER_HOST, idle_timeout=IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.ssl_context = ssl.create_default_context()
+
+    def configure(self, max_idle=None, idle_timeout=None):
+        with self.lock:
+            if max_idle is not None:
+                self.max_idle = max_idle
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+
+    def acquire(self, key):
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self.lock:
+            pool = self.idle.get(key, [])
+            while pool:
+                c, last_used = pool.pop()
+                if now - last_used > self.idle_timeout:
+                    stale.append(c)
+                else:
+                    conn = c
+                    break
+        for c in stale:
+            c.close()
+            Metrics.incr("http_connections_evicted")
+        if conn is not None:
+            Metrics.incr("http_connections_reused")
+            return conn, True
+
+        return self._new_connection(key), False
+
+    def release(self, key, conn):
+        if conn.sock is None:
+            # Server asked us to close the connection, nothing worth keeping
+            conn.close()
+            return
+        with self.lock:
+            pool = self.idle.setdefault(key, [])
+            if len(pool) < self.max_idle:
+                pool.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            pools = list(self.idle.values())
+            self.idle = {}
+        for pool in pools:
+            for c, last_used in pool:
+                c.close()
+
+    def urlopen(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme in urllib.request.getproxies():
+            # Proxies are left to urllib
+            return self._urllib_open(url, body, headers)
+
+        for i in range(0, MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            scheme = parts.scheme.lower()
+            port = parts.port or (443 if scheme == "https" else 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or "/"
+            if parts.query:
+                path = path + "?" + parts.query
+            if body is not None and 'content-type' not in (k.lower() for k in headers):
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+            response, conn = self._send(key, method, path, body, headers)
+            Metrics.incr("http_requests")
+
+            if response.status in REDIRECT_CODES and response.getheader('location'):
+                response.read()
+                self.release(key, conn)
+                url = urllib.parse.urljoin(url, response.getheader('location'))
+                if response.status == 303 or (response.status in (301, 302) and method == "POST"):
+                    method = "GET"
+                    body = None
+                    headers = {k: v for k, v in headers.items() if k.lower() not in ('content-type', 'content-length')}
+                continue
+
+            if response.status >= 400:
+                error_body = response.read()
+                self.release(key, conn)
+                Metrics.incr("http_errors_{}".format(response.status))
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(error_body))
+
+            return PooledResponse(self, key, conn, response, url)
+
+        raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.msg, io.BytesIO(b""))
+
+    def _send(self, key, method, path, body, headers):
+        conn, reused = self.acquire(key)
+        try:
+            conn.request(method, path, body, headers)
+            return conn.getresponse(), conn
+        except STALE_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+        except Exception:
+            conn.close()
+            raise
+        # The idle connection went away under us, try once more on a fresh one
+        Metrics.incr("http_connections_stale")
+        conn = self._new_connection(key)
+        try:
+            conn.request(method, path, body, headers)
+            return conn.getresponse(), conn
+        except Exception:
+            conn.close()
+            raise
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        Metrics.incr("http_connections_opened")
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, context=self.ssl_context)
+        return http.client.HTTPConnection(host, port)
+
+    def _urllib_open(self, url, body, headers):
+        req = urllib.request.Request(url, body, headers)
+        Metrics.incr("http_requests")
+        Metrics.incr("http_connections_opened")
+        return urllib.request.urlopen(req)
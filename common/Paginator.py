@@ -0,0 +1,106 @@
+__author__ = 'aurcioli'
+import json
+import os
+
+
+class Paginator:
+    # Walks a paged listing one page at a time. After every page the items are appended to
+    # <name>.items.jsonl and the position of the next page is written to <name>.json, so an
+    # interrupted listing picks up where it stopped instead of starting over.
+    #
+    # fetch_page(position) returns (items, next_position); a next_position of None ends the listing.
+
+    def __init__(self, project, name, fetch_page, first_position=None):
+        self.project = project
+        self.name = name
+        self.fetch_page = fetch_page
+        self.first_position = first_position
+        self.position = first_position
+        self.count = 0
+        self.pages_fetched = 0
+        self.checkpoint_file = os.path.join(project.project_folders["listing"], name + ".json")
+        self.items_file = os.path.join(project.project_folders["listing"], name + ".items.jsonl")
+
+    def pages(self):
+        resumed = self._resume()
+        if resumed is not None:
+            if resumed:
+                yield resumed
+        else:
+            self._reset()
+
+        while self.position is not None or self.pages_fetched == 0:
+            items, next_position = self.fetch_page(self.position)
+            self._checkpoint(items, next_position)
+            self.position = next_position
+            self.pages_fetched += 1
+            yield items
+            if next_position is None:
+                break
+
+    def _resume(self):
+        if not os.path.isfile(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('complete') or not os.path.isfile(self.items_file):
+            return None
+
+        items = []
+        with open(self.items_file, 'rb+') as f:
+            for i in range(0, checkpoint['count']):
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    return None
+                items.append(json.loads(line.decode('utf-8')))
+            # Anything after the checkpointed count belongs to a page that never finished saving
+            f.truncate(f.tell())
+
+        self.position = checkpoint['position']
+        self.count = checkpoint['count']
+        self.pages_fetched = checkpoint['pages']
+        self.project.log("transaction", "Resuming {} listing at page {} ({} items already listed)".format(
+            self.name, self.pages_fetched + 1, self.count), "highlight", True)
+        return items
+
+    def _reset(self):
+        self.position = self.first_position
+        self.count = 0
+        self.pages_fetched = 0
+        self._write_checkpoint({"position": self.position, "count": 0, "pages": 0, "complete": False})
+        open(self.items_file, 'w').close()
+
+    def _checkpoint(self, items, next_position):
+        with open(self.items_file, 'a', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.count += len(items)
+        self._write_checkpoint({"position": next_position, "count": self.count, "pages": self.pages_fetched + 1,
+                                "complete": next_position is None})
+
+    def _write_checkpoint(self, checkpoint):
+        tmp = self.checkpoint_file + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp, self.checkpoint_file)
+
+    def completed_items(self):
+        # Items of the last listing that ran to completion, None if there is no such listing
+        if not os.path.isfile(self.checkpoint_file) or not os.path.isfile(self.items_file):
+            return None
+        with open(self.checkpoint_file, 'r') as f:
+            checkpoint = json.load(f)
+        if not checkpoint.get('complete'):
+            return None
+        items = []
+        with open(self.items_file, 'r', encoding='utf-8') as f:
+            for i in range(0, checkpoint['count']):
+                items.append(json.loads(f.readline()))
+        return items
+
+    def replace_items(self, items):
+        # Stores items as a completed listing, e.g. after changes were applied to it
+        self._reset()
+        self._checkpoint(items, None)
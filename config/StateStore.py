@@ -0,0 +1,55 @@
+import json
+import os
+import threading
+
+from config import ConfigLoader
+
+# Seconds changes are collected before they are written out together
+FLUSH_DELAY = 1.0
+
+
+class StateStore(dict):
+    # Project settings and acquisition state kept as JSON. Changes are made in memory and written
+    # behind, a moment later, to a temporary file that then replaces the old one so an interrupted
+    # write never leaves a broken file. Projects that still have a config.cfg are read from it once.
+
+    def __init__(self, path, legacy_path=None, defaults=None):
+        dict.__init__(self)
+        self.path = path
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.timer = None
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.update(json.load(f))
+        elif legacy_path and os.path.isfile(legacy_path):
+            legacy = ConfigLoader.ConfigLoader()
+            legacy.from_file(legacy_path)
+            self.update(legacy)
+            self.flush()
+        else:
+            self.update(defaults or {})
+            self.flush()
+
+    def set(self, key, value):
+        with self.lock:
+            self[key] = value
+            if self.timer is None:
+                # Not a daemon, whatever is still waiting gets written before the interpreter exits
+                self.timer = threading.Timer(FLUSH_DELAY, self.flush)
+                self.timer.start()
+
+    def flush(self):
+        # Snapshots are taken in the order they are written, an older one never replaces a newer one
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                data = json.dumps(self, sort_keys=True, indent=4)
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
@@ -0,0 +1,324 @@
+__author__ = 'aurcioli'
+import asyncio
+import collections
+import http.client
+import io
+import threading
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+
+from common import AsyncConnectionPool
+from common import Common
+from downloader import Pipeline
+from downloader import RateControl
+from downloader import Resume
+from metrics import Metrics
+
+# Bodies smaller than this are read completely before being handed to the storage callback,
+# anything bigger is streamed to it while it is still being received.
+BUFFER_LIMIT = 1024 * 1024
+STREAM_BACKLOG = 16
+
+
+class BodyStream(io.RawIOBase):
+    # File like object read by the storage callback on an executor thread while the event loop
+    # keeps feeding it chunks. The loop waits whenever the reader falls too far behind.
+
+    def __init__(self, loop, chunks):
+        super(BodyStream, self).__init__()
+        self.loop = loop
+        self.chunks = collections.deque(chunks)
+        self.cond = threading.Condition()
+        self.eof = False
+        self.error = None
+        self.pending = b''
+        self.abandoned = False
+        self.space = asyncio.Event()
+
+    def readable(self):
+        return True
+
+    def abandon(self):
+        # The reader went away, whatever is still being received has nowhere to go
+        self.abandoned = True
+        self.space.set()
+
+    async def feed(self, chunk):
+        while not self.abandoned:
+            with self.cond:
+                if len(self.chunks) < STREAM_BACKLOG:
+                    self.chunks.append(chunk)
+                    self.cond.notify()
+                    return
+                self.space.clear()
+            await self.space.wait()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.eof = True
+            self.error = error
+            self.cond.notify()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            buf = bytearray()
+            while True:
+                data = self.read(io.DEFAULT_BUFFER_SIZE * 8)
+                if not data:
+                    return bytes(buf)
+                buf += data
+        if not self.pending:
+            with self.cond:
+                while not self.chunks and not self.eof:
+                    self.cond.wait()
+                if self.chunks:
+                    self.pending = self.chunks.popleft()
+                    self.loop.call_soon_threadsafe(self.space.set)
+                elif self.error:
+                    raise self.error
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class AsyncDownloader(Pipeline.Stage, Queue):
+    # Drop in replacement for Downloader.Downloader that runs every transfer as a coroutine on a
+    # single event loop thread. Storage callbacks and anything else that blocks run on an executor.
+
+    headers = ""
+    storage_callback = None
+    threads = 3
+    concurrency = 100
+
+    def __init__(self, project, http_callback, storage_callback, get_headers, threads, maxsize=0):
+        self.storage_callback = storage_callback
+        self.headers = get_headers
+        self.threads = threads
+        self.concurrency = getattr(project.args, 'concurrency', AsyncDownloader.concurrency)
+        self.http_callback = http_callback
+        self.engine = None
+        self.stopped = False
+        self.adaptive = RateControl.AdaptiveConcurrency(self.concurrency, RateControl.max_concurrency(project, self.concurrency))
+        self.rate_limiter = project.rate_limiter
+        Queue.__init__(self, maxsize)
+        Pipeline.Stage.__init__(self, project, storage_callback.__name__.strip('_'))
+
+    def _stop_engine(self):
+        # Nothing else will be queued, the engine stops once it reaches this marker
+        if not self.stopped:
+            self.stopped = True
+            self.put(None)
+
+    def depth(self):
+        # Throttled slips waiting to be put back are still unfinished
+        return self.unfinished_tasks
+
+    def active(self):
+        return self.adaptive.active
+
+    def task_done(self):
+        Metrics.incr("slips_completed")
+        super(AsyncDownloader, self).task_done()
+        self._check_done()
+
+    def start(self):
+        self.engine = threading.Thread(target=self._run_loop)
+        self.engine.daemon = True
+        self.engine.name = "Downloading: async engine"
+        self.engine.start()
+
+    def wait_for_complete(self):
+        super(AsyncDownloader, self).wait_for_complete()
+        self._stop_engine()
+        if self.engine:
+            self.engine.join()
+
+    def _run_loop(self):
+        asyncio.run(self._main())
+        if self.project.shutdown_signal:
+            self.project.log("exception", "Async download engine received shutdown signal. Stopping...", "warning")
+        else:
+            self.project.log("transaction", "Async download engine has completed.", "info")
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        # Same limits as the pool of the threaded engine, set from --pool-size
+        self.pool = AsyncConnectionPool.AsyncConnectionPool(Common.pool.max_idle, Common.pool.idle_timeout)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="Storage")
+        self.slips = asyncio.Queue(self.concurrency)
+        self.slot_freed = asyncio.Event()
+        try:
+            dispatcher = asyncio.ensure_future(self._dispatcher())
+            workers = [asyncio.ensure_future(self._downloader()) for i in range(0, self.adaptive.maximum)]
+            for result in await asyncio.gather(*workers, return_exceptions=True):
+                if isinstance(result, Exception):
+                    self.project.log("exception", "Async download worker failed - {}".format(repr(result)), "critical")
+            dispatcher.cancel()
+        finally:
+            self.pool.clear()
+            self.executor.shutdown(wait=True)
+
+    async def _dispatcher(self):
+        # Moves slips from the thread safe queue the providers fill onto the loop
+        while not self.project.shutdown_signal:
+            try:
+                slip = await self.loop.run_in_executor(None, self.get, True, 1)
+            except Empty:
+                continue
+            if slip is None:
+                self.task_done()
+                for i in range(0, self.adaptive.maximum):
+                    await self.slips.put(None)
+                return
+            await self.slips.put(slip)
+        # Workers drop what is still on the loop queue once shutting down, each leaves at a marker
+        for i in range(0, self.adaptive.maximum):
+            await self.slips.put(None)
+
+    async def _downloader(self):
+        while True:
+            if self.project.pause_signal:
+                await self.loop.run_in_executor(None, self.project.running.wait)
+            slip = await self.slips.get()
+            if slip is None:
+                break
+            if self.project.shutdown_signal:
+                self.task_done()
+                continue
+            requeued = False
+            try:
+                requeued = await self._download(slip)
+            except Exception as err:
+                self.project.log("exception", "{} failed - {}".format(slip.item[slip.filename_key], repr(err)), "critical", True)
+            finally:
+                if not requeued:
+                    self.task_done()
+
+    async def _download(self, slip):
+        # Returns True if the slip was rejected by the API and will be queued again
+        while not self.adaptive.try_acquire():
+            if self.project.shutdown_signal:
+                return False
+            self.slot_freed.clear()
+            try:
+                await asyncio.wait_for(self.slot_freed.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+        completed = False
+        offset = 0
+        try:
+            delay = self.rate_limiter.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            if callable(slip.url):
+                file_url = await self.loop.run_in_executor(self.executor, slip.url)
+            else:
+                file_url = slip.url
+            self.project.log("transaction", "Downloading " + slip.item[slip.filename_key], "info", True)
+            offset, validator = self.project.resume_point(slip.savepath)
+            await self._transfer(file_url, slip, offset, validator)
+            completed = True
+        except urllib.error.HTTPError as err:
+            if RateControl.is_throttled(err):
+                return self._throttled(slip, err)
+            if err.code == 416 and offset:
+                # The partial file doesn't fit the remote one anymore
+                self.project.discard_partial(slip.savepath)
+                return self._failed(slip, err)
+            self.project.log("exception", "{} failed to download - HTTPError {}".format(slip.item[slip.filename_key], err.code), "warning")
+        except (http.client.HTTPException, OSError) as err:
+            return self._failed(slip, err)
+        finally:
+            self.adaptive.release(completed)
+            self.slot_freed.set()
+        return False
+
+    def _throttled(self, slip, err):
+        Metrics.incr("http_throttled")
+        self.adaptive.throttled()
+        self.rate_limiter.throttled()
+        slip.attempts += 1
+        name = slip.item[slip.filename_key]
+        if slip.attempts > RateControl.MAX_ATTEMPTS:
+            self.project.log("exception", "{} failed to download - still rate limited after {} attempts".format(name, RateControl.MAX_ATTEMPTS), "warning")
+            return False
+        delay = RateControl.backoff(err, slip.attempts)
+        Metrics.incr("retries")
+        self.project.log("exception", "{} was rate limited (HTTPError {}), retrying in {:.1f}s. Concurrency is now {}".format(
+            name, err.code, delay, self.adaptive.limit), "warning")
+        RateControl.requeue_later(self, slip, delay)
+        return True
+
+    def _failed(self, slip, err):
+        # Broken connections and transfers are retried, whatever was received is picked up again
+        slip.attempts += 1
+        name = slip.item[slip.filename_key]
+        if slip.attempts > RateControl.MAX_ATTEMPTS:
+            self.project.log("exception", "{} failed to download after {} attempts - {}".format(name, RateControl.MAX_ATTEMPTS, repr(err)), "critical", True)
+            return False
+        delay = RateControl.retry_delay(slip.attempts)
+        Metrics.incr("retries")
+        self.project.log("exception", "{} failed to download - {}, retrying in {:.1f}s".format(name, repr(err), delay), "warning")
+        RateControl.requeue_later(self, slip, delay)
+        return True
+
+    async def _transfer(self, url, slip, offset=0, validator=None):
+        # Getting the headers may renew the OAuth token
+        headers = Resume.resume_headers(await self.loop.run_in_executor(self.executor, self.headers), offset, validator)
+        method, body = "GET", None
+        if slip.data is not None:
+            headers['Content-Type'] = slip.content_type
+            method, body = "POST", slip.data.encode('utf-8')
+        while True:
+            try:
+                headers['user-agent'] = "searchgiant forensic cli"
+                response = await self.pool.urlopen(method, url, body, headers)
+                break
+            except urllib.error.HTTPError as err:
+                err.request_headers = headers
+                new_headers = await self.loop.run_in_executor(self.executor, self.http_callback, err)
+                if not new_headers:
+                    raise
+                # Only what the callback replaced changes, a Range or Content-Type stays
+                headers = dict(headers, **new_headers)
+        Resume.resumed_from(slip, response, offset)
+
+        chunks = []
+        buffered = 0
+        while buffered <= BUFFER_LIMIT:
+            try:
+                data = await response.read_chunk()
+            except Exception as err:
+                if chunks:
+                    # The storage callback still gets to keep what was received
+                    stream = BodyStream(self.loop, chunks)
+                    stream.finish(err)
+                    await asyncio.gather(self.loop.run_in_executor(self.executor, self.storage_callback, stream, slip), return_exceptions=True)
+                raise
+            if not data:
+                await self.loop.run_in_executor(self.executor, self.storage_callback, io.BytesIO(b''.join(chunks)), slip)
+                return
+            chunks.append(data)
+            buffered += len(data)
+
+        stream = BodyStream(self.loop, chunks)
+        storing = self.loop.run_in_executor(self.executor, self.storage_callback, stream, slip)
+        storing.add_done_callback(lambda f: stream.abandon())
+        try:
+            while True:
+                data = await response.read_chunk()
+                if not data:
+                    break
+                await stream.feed(data)
+        except Exception as err:
+            stream.finish(err)
+            await asyncio.gather(storing, return_exceptions=True)
+            raise
+        stream.finish()
+        await storing
@@ -1,80 +1,360 @@
 __author__ = 'alexander'
-from queue import Queue
-from threading import Thread
+import http.client
+import io
+import os
 import threading
-import time
 import urllib
 
 from common import Common
+from downloader import AsyncDownloader
+from downloader import Pipeline
+from downloader import RateControl
+from downloader import Resume
+from downloader import Scheduler
+from metrics import Metrics
 
 
 class DownloadSlip:
 
-    def __init__(self, url, item, savepath, fname_key):
+    def __init__(self, url, item, savepath, fname_key, size=None, md5=None, metadata=False, modified=None):
         self.url = url
         self.item = item
         self.savepath = savepath
         self.filename_key = fname_key
+        self.attempts = 0
+        # Where the body handed to the storage callback starts and what identifies its version
+        self.offset = 0
+        self.validator = None
+        # Known size and md5 of the remote file. Files with a size may be downloaded in segments.
+        self.size = int(size) if size is not None else None
+        self.md5 = md5
+        # Metadata slips run before files. modified (epoch seconds) is used by --order newest/oldest.
+        self.metadata = metadata
+        self.modified = modified
+        # Body and its Content-Type of slips that are POSTed rather than fetched
+        self.data = None
+        self.content_type = None
 
-class Downloader(Queue):
+
+class Segment:
+    # Byte range [start, end] of a SegmentedTransfer. start moves up as data is written.
+
+    def __init__(self, transfer, start, end):
+        self.transfer = transfer
+        self.start = start
+        self.end = end
+        self.attempts = 0
+        self.item = transfer.slip.item
+        self.filename_key = transfer.slip.filename_key
+        self.url = transfer.url
+        self.metadata = False
+        self.size = end - start + 1
+        self.modified = transfer.slip.modified
+
+
+class SegmentedTransfer:
+    # One big file being downloaded by several workers at once, each writing its byte range
+    # straight into its place in the preallocated .part file.
+
+    def __init__(self, slip, url, part, count, validator=None):
+        self.slip = slip
+        self.url = url
+        self.part = part
+        self.remaining = count
+        self.lock = threading.Lock()
+        self.error = None
+        # ETag or Last-Modified of the version being assembled, every segment has to be of it
+        self.validator = validator
+        # Set when the server ignores Range, the file is downloaded in one piece instead
+        self.unsegmentable = False
+        self.fd = os.open(part, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+
+    def same_version(self, response):
+        # The first segment answered decides the version when there is no partial file to go on
+        validator = response.getheader('ETag') or response.getheader('Last-Modified')
+        with self.lock:
+            if self.validator is None:
+                self.validator = validator
+            return validator == self.validator
+
+    def preallocate(self, size):
+        os.ftruncate(self.fd, size)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except OSError:
+                pass
+
+    def write_at(self, data, position):
+        if hasattr(os, 'pwrite'):
+            while data:
+                written = os.pwrite(self.fd, data, position)
+                data = data[written:]
+                position += written
+        else:
+            with self.lock:
+                os.lseek(self.fd, position, os.SEEK_SET)
+                while data:
+                    data = data[os.write(self.fd, data):]
+
+    def close(self):
+        os.close(self.fd)
+
+# How many slips a lister may run ahead of the workers when listing and downloading overlap
+STREAM_QUEUE_SIZE = 1000
+# Files at least this big (in MiB, see --segment-threshold) are split into byte ranges
+SEGMENT_THRESHOLD = 64
+MIN_SEGMENT = 8 * 1024 * 1024
+SEGMENT_BLOCK = 1024 * 1024
+
+
+def get_downloader(project, http_callback, storage_callback, get_headers, threads, maxsize=0):
+    if getattr(project.args, 'engine', "threaded") == "async":
+        return AsyncDownloader.AsyncDownloader(project, http_callback, storage_callback, get_headers, threads, maxsize)
+    return Downloader(project, http_callback, storage_callback, get_headers, threads, maxsize)
+
+
+class Downloader(Pipeline.Stage):
+    # One stage of an acquisition. Slips put here are run by the workers of the project's
+    # Scheduler, shared with every other stage, in the order of their priority class.
 
     headers = ""
     storage_callback = None
     threads = 3
 
-    def __init__(self, project, http_callback, storage_callback, get_headers, threads):
+    def __init__(self, project, http_callback, storage_callback, get_headers, threads, maxsize=0):
 
-        self.project = project
         self.storage_callback = storage_callback
         self.headers = get_headers
         self.threads = threads
         self.http_callback = http_callback
-        super(Downloader, self).__init__()
-
-    def wait_for_complete(self):
-        running = True
-        while not self.empty():
-            time.sleep(3)
-        while running:
-            download_thread = False
-            for t in threading.enumerate():
-                if 'Downloading' in t.name:
-                    download_thread = True
-            if not download_thread:
-                running = False
-            time.sleep(0.001)
+        self.scheduler = project.scheduler
+        self.rate_limiter = project.rate_limiter
+        threshold = getattr(project.args, 'segment_threshold', SEGMENT_THRESHOLD)
+        self.segment_threshold = threshold * 1024 * 1024 if threshold else 0
+        self.maxsize = maxsize
+        # Slips put but not finished yet, including those waiting for a retry
+        self.pending = 0
+        self.started = False
+        self.held = []
+        super(Downloader, self).__init__(project, storage_callback.__name__.strip('_'))
+
+    def put(self, slip):
+        with self.cond:
+            # Listers wait when they run too far ahead. Workers never do, the slots they would
+            # wait for may be their own.
+            if self.maxsize and not self.scheduler.is_worker():
+                while self.pending >= self.maxsize and not self.project.shutdown_signal:
+                    self.cond.wait()
+            self.pending += 1
+            if not self.started:
+                self.held.append(slip)
+                return
+        self.scheduler.submit(self, slip)
 
     def start(self):
-        for i in range(0, self.threads):
-            t = Thread(target=self._downloader)
-            t.daemon = True
-            t.name = "Download thread " + str(i)
-            t.start()
-
-    def _downloader(self):
-        while (not self.empty()) and (not self.project.shutdown_signal):
-            t = threading.current_thread()
-            Common.check_for_pause(self.project)
-            slip = self.get()
+        with self.cond:
+            self.started = True
+            held, self.held = self.held, []
+        self.scheduler.start()
+        for slip in held:
+            self.scheduler.submit(self, slip)
+
+    def run(self, slip):
+        # Called by a Scheduler worker, returns True if a transfer completed
+        if isinstance(slip, Segment):
+            return self._download_segment(slip)
+        return self._download(slip)
+
+    def depth(self):
+        # Throttled slips waiting to be put back are still pending
+        return self.pending
+
+    def _done(self):
+        Metrics.incr("slips_completed")
+        with self.cond:
+            self.pending -= 1
+            self.cond.notify_all()
+        self._check_done()
+
+    def _requeue_later(self, slip, delay, priority=None):
+        # The slip stays pending until it is back with the scheduler
+        timer = threading.Timer(delay, self.scheduler.submit, (self, slip, priority))
+        timer.daemon = True
+        timer.start()
+
+    def _download(self, slip):
+        completed = False
+        requeued = False
+        offset = 0
+        try:
+            self.rate_limiter.acquire()
             if callable(slip.url):
                 file_url = slip.url()
             else:
                 file_url = slip.url
-            t.name = 'Downloading: ' + slip.item[slip.filename_key]
+            threading.current_thread().name = 'Downloading: ' + slip.item[slip.filename_key]
             self.project.log("transaction", "Downloading " + slip.item[slip.filename_key], "info", True)
-            try:
-                data = Common.webrequest(file_url, self.headers(), self.http_callback, None, False, True) # Response object gets passed to shutil.copyfileobj
-                self.storage_callback(data, slip)
-            except urllib.error.HTTPError as err:
+            offset, validator = self.project.resume_point(slip.savepath)
+            if self.segment_threshold and slip.size and slip.size - offset >= self.segment_threshold:
+                # The slip stays pending until its last segment is done
+                requeued = True
+                self._split(slip, file_url, offset, validator)
+                return False
+            headers = Resume.resume_headers(self.headers(), offset, validator)
+            if slip.data is not None:
+                headers['Content-Type'] = slip.content_type
+            data = Common.webrequest(file_url, headers, self.http_callback, slip.data, False, True) # Response object gets passed to shutil.copyfileobj
+            Resume.resumed_from(slip, data, offset)
+            self.storage_callback(data, slip)
+            completed = True
+        except urllib.error.HTTPError as err:
+            if RateControl.is_throttled(err):
+                requeued = self._throttled(slip, err)
+            elif err.code == 416 and offset:
+                # The partial file doesn't fit the remote one anymore
+                self.project.discard_partial(slip.savepath)
+                requeued = self._failed(slip, err)
+            else:
                 self.project.log("exception", "{} failed to download - HTTPError {}".format(slip.item[slip.filename_key], err.code), "warning")
-        if self.project.shutdown_signal:
-            self.project.log("exception", "{} received shutdown signal. Stopping...".format(threading.current_thread().name), "warning")
-        else:
-            self.project.log("transaction", "{} has completed.".format(threading.current_thread().name), "info")
-
+        except (http.client.HTTPException, OSError) as err:
+            requeued = self._failed(slip, err)
+        finally:
+            if not requeued:
+                self._done()
+        return completed
 
+    def _split(self, slip, url, offset, validator):
+        # Segments go ahead of everything else so started files finish first
+        count = max(2, min(self.scheduler.budget.maximum, (slip.size - offset) // MIN_SEGMENT))
+        length = -(-(slip.size - offset) // count)
+        transfer = SegmentedTransfer(slip, url, self.project.partial_path(slip.savepath), count, validator if offset else None)
+        transfer.preallocate(slip.size)
+        segments = [Segment(transfer, start, min(start + length, slip.size) - 1) for start in range(offset, slip.size, length)]
+        transfer.remaining = len(segments)
+        self.project.log("transaction", "Downloading {} in {} segments".format(slip.item[slip.filename_key], len(segments)), "info", True)
+        Metrics.incr("segmented_downloads")
+        with self.cond:
+            self.pending += len(segments)
+        for segment in segments:
+            self.scheduler.submit(self, segment, Scheduler.SEGMENT)
 
+    def _download_segment(self, segment):
+        transfer = segment.transfer
+        if transfer.error is not None or transfer.unsegmentable:
+            self._segment_done(segment)
+            return False
+        completed = False
+        requeued = False
+        try:
+            self.rate_limiter.acquire()
+            headers = self.headers()
+            headers['Range'] = "bytes={}-{}".format(segment.start, segment.end)
+            if transfer.validator:
+                # A file that changed since comes back whole instead of as this range
+                headers['If-Range'] = transfer.validator
+            response = Common.webrequest(transfer.url, headers, self.http_callback, None, False, True)
+            with response:
+                # Either way the file is downloaded again in one piece
+                if response.status != 206 or not transfer.same_version(response):
+                    transfer.unsegmentable = True
+                    return False
+                while segment.start <= segment.end:
+                    data = response.read(min(SEGMENT_BLOCK, segment.end - segment.start + 1))
+                    if not data:
+                        raise http.client.IncompleteRead(b'', segment.end - segment.start + 1)
+                    transfer.write_at(data, segment.start)
+                    segment.start += len(data)
+            completed = True
+        except urllib.error.HTTPError as err:
+            if RateControl.is_throttled(err):
+                requeued = self._throttled(segment, err, transfer)
+            else:
+                transfer.error = err
+        except (http.client.HTTPException, OSError) as err:
+            segment.attempts += 1
+            if segment.attempts <= RateControl.MAX_ATTEMPTS:
+                # Picks up where this segment stopped
+                Metrics.incr("retries")
+                self._requeue_later(segment, RateControl.retry_delay(segment.attempts), Scheduler.SEGMENT)
+                requeued = True
+            else:
+                transfer.error = err
+        except Exception as err:
+            transfer.error = err
+        finally:
+            # The transfer is finished by its last segment, whatever happened to this one
+            if not requeued:
+                self._segment_done(segment)
+        return completed
 
+    def _segment_done(self, segment):
+        transfer = segment.transfer
+        with transfer.lock:
+            transfer.remaining -= 1
+            last = transfer.remaining == 0
+        self._done()
+        if last:
+            self._finish_transfer(transfer)
 
+    def _finish_transfer(self, transfer):
+        slip = transfer.slip
+        name = slip.item[slip.filename_key]
+        transfer.close()
+        requeue = False
+        try:
+            if transfer.unsegmentable:
+                self.project.log("exception", "{} can't be downloaded in segments, downloading it in one piece".format(name), "warning")
+                self.project.discard_partial(slip.savepath)
+                slip.size = None
+                requeue = True
+            elif transfer.error is not None:
+                self.project.discard_partial(slip.savepath)
+                self.project.log("exception", "{} failed to download - {}".format(name, repr(transfer.error)), "critical", True)
+            else:
+                # The segments filled the whole .part file, storing it only has to hash and rename it
+                slip.offset = slip.size
+                digests = self.storage_callback(io.BytesIO(b''), slip)
+                if slip.md5 and digests and digests['md5'] != slip.md5:
+                    self.project.log("exception", "{} does not match its md5 after a segmented download, downloading it in one piece".format(name), "critical", True)
+                    slip.size = None
+                    slip.attempts += 1
+                    requeue = slip.attempts <= RateControl.MAX_ATTEMPTS
+        except (http.client.HTTPException, OSError) as err:
+            self.project.log("exception", "{} could not be stored - {}".format(name, repr(err)), "critical", True)
+        finally:
+            if requeue:
+                self._requeue_later(slip, 0)
+            else:
+                self._done()
 
+    def _throttled(self, slip, err, transfer=None):
+        Metrics.incr("http_throttled")
+        self.scheduler.throttled()
+        self.rate_limiter.throttled()
+        slip.attempts += 1
+        name = slip.item[slip.filename_key]
+        if slip.attempts > RateControl.MAX_ATTEMPTS:
+            self.project.log("exception", "{} failed to download - still rate limited after {} attempts".format(name, RateControl.MAX_ATTEMPTS), "warning")
+            if transfer is not None:
+                transfer.error = err
+            return False
+        delay = RateControl.backoff(err, slip.attempts)
+        Metrics.incr("retries")
+        self.project.log("exception", "{} was rate limited (HTTPError {}), retrying in {:.1f}s. Concurrency is now {}".format(
+            name, err.code, delay, self.scheduler.budget.limit), "warning")
+        self._requeue_later(slip, delay, Scheduler.SEGMENT if transfer is not None else None)
+        return True
 
+    def _failed(self, slip, err):
+        # Broken connections and transfers are retried, whatever was received is picked up again
+        slip.attempts += 1
+        name = slip.item[slip.filename_key]
+        if slip.attempts > RateControl.MAX_ATTEMPTS:
+            self.project.log("exception", "{} failed to download after {} attempts - {}".format(name, RateControl.MAX_ATTEMPTS, repr(err)), "critical", True)
+            return False
+        delay = RateControl.retry_delay(slip.attempts)
+        Metrics.incr("retries")
+        self.project.log("exception", "{} failed to download - {}, retrying in {:.1f}s".format(name, repr(err), delay), "warning")
+        self._requeue_later(slip, delay)
+        return True
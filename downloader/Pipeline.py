@@ -0,0 +1,66 @@
+__author__ = 'aurcioli'
+import threading
+
+
+class Stage:
+    # One step of an acquisition that slips are put into. Stages can feed each other: the storage
+    # callback of one puts slips into the next while both are running. A stage is complete once
+    # it was closed, every stage feeding it is complete and nothing it was given is left.
+
+    def __init__(self, project, name):
+        self.project = project
+        self.name = name
+        self.upstream = []
+        self.downstream = []
+        self.closed = False
+        self.done = threading.Event()
+        self.cond = threading.Condition()
+        project.add_stage(self)
+
+    def feeds(self, stage):
+        stage.upstream.append(self)
+        self.downstream.append(stage)
+        return stage
+
+    def close(self):
+        # Nothing but the stages feeding this one will put anything here anymore
+        with self.cond:
+            self.closed = True
+        self._check_done()
+
+    def wake(self):
+        # Called when the project is paused, resumed or shut down
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait_for_complete(self):
+        self.close()
+        with self.cond:
+            while not self.done.is_set() and not self.project.shutdown_signal:
+                self.cond.wait()
+
+    def stop(self):
+        # Called when the project shuts down, stages with threads of their own end them here
+        pass
+
+    def depth(self):
+        # Slips put here that aren't finished yet
+        raise NotImplementedError
+
+    def active(self):
+        # Requests this stage runs itself, not counting those run by the project's Scheduler
+        return 0
+
+    def _idle(self):
+        return self.depth() == 0
+
+    def _check_done(self):
+        with self.cond:
+            if self.done.is_set() or not self.closed or not self._idle():
+                return
+            if not all(stage.done.is_set() for stage in self.upstream):
+                return
+            self.done.set()
+            self.cond.notify_all()
+        for stage in self.downstream:
+            stage._check_done()
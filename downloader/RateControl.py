@@ -0,0 +1,216 @@
+__author__ = 'aurcioli'
+import json
+import random
+import threading
+import time
+
+from metrics import Metrics
+
+# Reasons Google gives in 403 bodies when a quota, not a permission, is the problem
+THROTTLE_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+# Seconds over which throughput is measured before concurrency or rate are adjusted
+WINDOW = 2.0
+# A window has to beat the best one so far by this much to count as an improvement
+IMPROVEMENT = 0.05
+# Windows without improvement before we try going up again
+PROBE_WINDOWS = 5
+# Requests per second added to the rate limit after every window without throttling
+RATE_STEP = 1.0
+MIN_RATE = 0.5
+
+# Requeue backoff, full jitter between 0 and min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt)
+BACKOFF_BASE = 1.0
+MAX_BACKOFF = 60.0
+MAX_ATTEMPTS = 10
+
+# Without --max-concurrency, concurrency may grow up to this many times the starting value
+CONCURRENCY_HEADROOM = 4
+
+
+def max_concurrency(project, initial):
+    return getattr(project.args, 'max_concurrency', None) or initial * CONCURRENCY_HEADROOM
+
+
+def is_throttled(err):
+    # True if an HTTPError means we are going too fast rather than that the request is wrong
+    if err.code == 429:
+        return True
+    if err.code != 403:
+        return False
+    body = getattr(err, 'throttle_body', None)
+    if body is None:
+        try:
+            body = err.read()
+        except Exception:
+            body = b''
+        err.throttle_body = body
+    try:
+        errors = json.loads(body.decode('utf-8'))['error'].get('errors', [])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+    return any(e.get('reason') in THROTTLE_REASONS for e in errors)
+
+
+def retry_delay(attempt):
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * (2 ** attempt)))
+
+
+def backoff(err, attempt):
+    delay = retry_delay(attempt)
+    retry_after = err.headers.get('retry-after') if err.headers else None
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+    return delay
+
+
+def requeue_later(queue, slip, delay):
+    # The task of the rejected attempt stays open until the slip is back in the queue, so
+    # anything waiting for the queue to drain waits for it too
+    def requeue():
+        queue.put(slip)
+        queue.task_done()
+    timer = threading.Timer(delay, requeue)
+    timer.daemon = True
+    timer.start()
+
+
+class TokenBucket:
+    # Request rate limiter shared by everything that talks to one provider. Starts unlimited
+    # unless given a rate; the first throttle sets the rate to half of what was getting through.
+    # After that the rate is cut in half on every throttle and grows by RATE_STEP per window in which
+    # it was reached without being throttled.
+
+    def __init__(self, rate=None):
+        self.rate = rate or None
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.window_start = self.last
+        self.window_requests = 0
+        self.observed = 0.0
+        self.throttled_at = 0.0
+
+    def reserve(self):
+        # Takes a token and returns how long the caller has to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self._roll_window(now)
+            self.window_requests += 1
+            if self.rate is None:
+                return 0
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.throttled_at < WINDOW:
+                # Requests that were already in flight, the rate has been cut for them
+                return
+            self.throttled_at = now
+            self._roll_window(now)
+            current = max(self.observed, self.window_requests / max(now - self.window_start, 0.001))
+            if self.rate is not None:
+                current = min(self.rate, current)
+            self.rate = max(MIN_RATE, current / 2)
+            self.tokens = min(self.tokens, 0)
+            self.last = now
+            Metrics.incr("rate_limit_decreases")
+
+    def _roll_window(self, now):
+        elapsed = now - self.window_start
+        if elapsed < WINDOW:
+            return
+        self.observed = self.window_requests / elapsed
+        self.window_start = now
+        self.window_requests = 0
+        # Only worth raising while the limit is what holds requests back
+        if self.rate is not None and now - self.throttled_at >= WINDOW and self.observed >= self.rate * 0.9:
+            self.rate += RATE_STEP
+
+
+class AdaptiveConcurrency:
+    # AIMD limit on the number of requests a downloader has in flight. One more slot is opened
+    # after every window in which throughput improved, the limit is halved whenever the remote
+    # end tells us to slow down.
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = minimum
+        self.maximum = max(initial, maximum)
+        self.limit = max(minimum, initial)
+        self.active = 0
+        self.cond = threading.Condition()
+        self.window_start = time.monotonic()
+        self.completed = 0
+        self.best = 0.0
+        self.stale_windows = 0
+        self.throttled_at = 0.0
+
+    def try_acquire(self):
+        with self.cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            return False
+
+    def acquire(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.active < self.limit, timeout):
+                return False
+            self.active += 1
+            return True
+
+    def release(self, completed=True):
+        with self.cond:
+            self.active -= 1
+            if completed:
+                self.completed += 1
+                self._adjust(time.monotonic())
+            self.cond.notify_all()
+
+    def throttled(self):
+        with self.cond:
+            now = time.monotonic()
+            if now - self.throttled_at < WINDOW:
+                return
+            self.throttled_at = now
+            self.limit = max(self.minimum, self.limit // 2)
+            self.best = 0.0
+            self.stale_windows = 0
+            self._restart_window(now)
+        Metrics.incr("concurrency_decreases")
+
+    def _adjust(self, now):
+        elapsed = now - self.window_start
+        if elapsed < WINDOW:
+            return
+        throughput = self.completed / elapsed
+        self._restart_window(now)
+        if now - self.throttled_at < WINDOW:
+            return
+        if throughput > self.best * (1 + IMPROVEMENT):
+            self.best = throughput
+            self.stale_windows = 0
+            if self.limit < self.maximum and self.active >= self.limit - 1:
+                self.limit += 1
+                Metrics.incr("concurrency_increases")
+        else:
+            self.stale_windows += 1
+            if self.stale_windows >= PROBE_WINDOWS:
+                # Conditions change, compare against what we get now instead of an old best
+                self.best = throughput
+                self.stale_windows = 0
+
+    def _restart_window(self, now):
+        self.window_start = now
+        self.completed = 0
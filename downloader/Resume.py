@@ -0,0 +1,15 @@
+__author__ = 'aurcioli'
+
+
+def resume_headers(headers, offset, validator):
+    # Asks for the rest of a partial download
+    if offset:
+        headers['Range'] = "bytes={}-".format(offset)
+        # The server sends the whole body instead if the file changed since
+        headers['If-Range'] = validator
+    return headers
+
+
+def resumed_from(slip, response, offset):
+    slip.offset = offset if offset and response.status == 206 else 0
+    slip.validator = response.getheader('ETag') or response.getheader('Last-Modified')
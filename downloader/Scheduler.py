@@ -0,0 +1,155 @@
+__author__ = 'aurcioli'
+import heapq
+import itertools
+import threading
+import urllib.parse
+from threading import Thread
+
+from common import Common
+from downloader import RateControl
+
+# Priority classes, lower runs first. Segments of files that are already being downloaded go
+# before anything else so started files finish, then metadata, then files from small to large.
+SEGMENT = 0
+METADATA = 1
+SMALL_FILE = 2
+LARGE_FILE = 3
+
+# Order of slips within a priority class
+ORDERS = ("fifo", "newest", "oldest", "smallest", "largest")
+
+
+def parse_host_limits(values):
+    # ["www.googleapis.com=4", ...] as given with --host-limit
+    limits = {}
+    for value in values or []:
+        host, sep, limit = value.rpartition('=')
+        if not sep or not host or not limit.isdigit() or int(limit) < 1:
+            raise ValueError("Host limits look like host=N, got '{}'".format(value))
+        limits[host.lower()] = int(limit)
+    return limits
+
+
+class Scheduler:
+    # One pool of workers for every threaded downloader of a project. Slips are run in priority
+    # order as long as the worker budget and the limit of the host they go to allow it. The budget
+    # starts at --threads and is adjusted to what the remote end accepts (see RateControl).
+
+    def __init__(self, project, threads, maximum, order="fifo", host_limits=None, large_file=0):
+        self.project = project
+        self.budget = RateControl.AdaptiveConcurrency(threads, maximum)
+        self.order = order
+        self.host_limits = host_limits or {}
+        self.large_file = large_file
+        self.cond = threading.Condition()
+        self.ready = {}
+        self.host_active = {}
+        self.seq = itertools.count()
+        self.workers = []
+        self.stopped = False
+        self.local = threading.local()
+
+    def start(self):
+        with self.cond:
+            if self.workers:
+                return
+            for i in range(0, self.budget.maximum):
+                t = Thread(target=self._worker)
+                t.daemon = True
+                t.name = "Download thread " + str(i)
+                self.workers.append(t)
+        for t in self.workers:
+            t.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for t in self.workers:
+            t.join()
+
+    def is_worker(self):
+        return getattr(self.local, 'worker', False)
+
+    def submit(self, downloader, slip, priority=None):
+        if priority is None:
+            priority = self._classify(slip)
+        host = self._host(slip)
+        with self.cond:
+            heapq.heappush(self.ready.setdefault(host, []), ((priority, self._order_key(slip), next(self.seq)), downloader, slip))
+            self.cond.notify()
+
+    def throttled(self):
+        self.budget.throttled()
+
+    def wake(self):
+        # Called when the project is paused, resumed or shut down
+        with self.cond:
+            self.cond.notify_all()
+
+    def _classify(self, slip):
+        if slip.metadata:
+            return METADATA
+        if self.large_file and slip.size and slip.size >= self.large_file:
+            return LARGE_FILE
+        return SMALL_FILE
+
+    def _order_key(self, slip):
+        if self.order == "newest":
+            return -(slip.modified or 0)
+        if self.order == "oldest":
+            return slip.modified if slip.modified is not None else float('inf')
+        if self.order == "smallest":
+            return slip.size or 0
+        if self.order == "largest":
+            return -(slip.size or 0)
+        return 0
+
+    def _host(self, slip):
+        # URLs that are only looked up when the slip runs can't be told apart, they share one host
+        if callable(slip.url):
+            return ""
+        return (urllib.parse.urlsplit(slip.url).hostname or "").lower()
+
+    def _next(self):
+        with self.cond:
+            while not self.stopped and not self.project.shutdown_signal:
+                if not self.project.pause_signal:
+                    best = None
+                    for host, heap in self.ready.items():
+                        if not heap or self.host_active.get(host, 0) >= self.host_limits.get(host, self.budget.maximum):
+                            continue
+                        if best is None or heap[0][0] < self.ready[best][0][0]:
+                            best = host
+                    if best is not None and self.budget.try_acquire():
+                        self.host_active[best] = self.host_active.get(best, 0) + 1
+                        entry = heapq.heappop(self.ready[best])
+                        return best, entry[1], entry[2]
+                self.cond.wait()
+        return None
+
+    def _release(self, host, completed):
+        self.budget.release(completed)
+        with self.cond:
+            self.host_active[host] -= 1
+            self.cond.notify_all()
+
+    def _worker(self):
+        self.local.worker = True
+        while True:
+            Common.check_for_pause(self.project)
+            work = self._next()
+            if work is None:
+                break
+            host, downloader, slip = work
+            completed = False
+            try:
+                completed = downloader.run(slip)
+            except Exception as err:
+                self.project.log("exception", "{} failed - {}".format(slip.item[slip.filename_key], repr(err)), "critical", True)
+            finally:
+                self._release(host, completed)
+        if self.project.shutdown_signal:
+            self.project.log("exception", "{} received shutdown signal. Stopping...".format(threading.current_thread().name), "warning")
+        else:
+            self.project.log("transaction", "{} has completed.".format(threading.current_thread().name), "info")
@@ -6,7 +6,9 @@ import os
 
 from onlinestorage import OnlineStorage
 from common import Common
+from common import Paginator
 from downloader import Downloader
+from metrics import Metrics
 from oi.IO import IO
 from oauth2providers import OAuth2Providers
 
@@ -24,15 +26,21 @@ class Dropbox(OnlineStorage.OnlineStorage):
         self.oauth_provider = OAuth2Providers.OAuth2Provider(self, "dropbox", 'access_token')
         self.files = []
         self.file_size_bytes = 0
+        self.cursor = None
+        self.change_log = None
+        self.reset = False
         # if 'OAUTH' in self.project.config:
         #     self.oauth = self.project.config['OAUTH']
         super(Dropbox, self).__init__(self, project.name)
 
     def metadata(self):
-        file_list_path = os.path.join(self.project.working_dir, Common.timely_filename("file_list",".csv"))
-        with open(file_list_path, 'w') as csv:
+        self.metadata_file = os.path.join(self.project.working_dir, Common.timely_filename("file_list",".csv"))
+        with open(self.metadata_file, 'w') as csv:
             csv.write("filename,bytes,size,revision,modified,mimeType,isDir,root,clientmTime\n")
-            for f in self.files:
+
+    def _add_metadata_rows(self, files):
+        with open(self.metadata_file, 'a') as csv:
+            for f in files:
                 row = []
                 row.append('None' if 'path' not in f else repr(f['path']))
                 row.append('0' if 'bytes' not in f else repr(f['bytes']))
@@ -44,26 +52,77 @@ class Dropbox(OnlineStorage.OnlineStorage):
                 row.append('None' if 'root' not in f else repr(f['root']))
                 row.append('None' if 'client_mtime' not in f else repr(f['client_mtime']))
                 csv.write(','.join('"' + item + '"' for item in row) + "\n")
-        csv.close()
 
     def verify(self):
         pass
 
     def sync(self):
         d1 = datetime.now()
-        d = Downloader.Downloader(self.project, self.oauth_provider.http_intercept, self._save_file, self.oauth_provider.get_auth_header, self.project.threads)
+        # With --prompt everything has to be listed before anything is downloaded,
+        # otherwise downloads start while the account is still being listed.
+        streaming = not self.project.args.prompt
+        incremental = self._can_acquire_incrementally()
+        d = Downloader.get_downloader(self.project, self.oauth_provider.http_intercept, self._save_file, self.oauth_provider.get_auth_header, self.project.threads,
+                                      Downloader.STREAM_QUEUE_SIZE if streaming else 0)
         if self.project.args.mode == "full":
             self.project.log("transaction", "Full acquisition initiated", "info", True)
         else:
             self.project.log("transaction", "Metadata acquisition initiated", "info", True)
 
-        self.initialize_items()
+        self.metadata()
+        cursor = None
+        if incremental:
+            cursor = self.project.config['DROPBOX_CURSOR']
+            self.change_log = os.path.join(self.project.working_dir, Common.timely_filename("changes", ".csv"))
+            with open(self.change_log, 'w') as log:
+                log.write("TIME_PROCESSED,PATH,ACTION\n")
+            self.project.log("transaction", "Fetching Dropbox changes since the last acquisition", "info", True)
+        if streaming:
+            d.start()
+            self.initialize_items(lambda files: self._queue_files(files, d), cursor)
+        else:
+            self.initialize_items(None, cursor)
+            self._queue_files(self.files, d)
+        if self.reset:
+            self._log_removed()
         cnt = len(self.files)
 
         self.project.log("transaction", "Total items queued for acquisition: " + str(cnt), "info", True)
-        self.metadata()
+        self.project.log("transaction", "Total size of files to be acquired is {}".format(Common.sizeof_fmt(self.file_size_bytes, "B")), "highlight", True)
+        if self.project.args.prompt:
+            IO.get("Press ENTER to begin acquisition...")
+        if not streaming:
+            d.start()
+
+        d.wait_for_complete()
+        if not self.project.shutdown_signal and self.cursor:
+            self.project.save("DROPBOX_CURSOR", self.cursor)
+        d2 = datetime.now()
+        delt = d2 - d1
 
-        for file in self.files:
+        self.project.log("transaction", "Acquisition completed in {}".format(str(delt)), "highlight", True)
+
+    def _can_acquire_incrementally(self):
+        if not getattr(self.project.args, 'incremental', False):
+            return False
+        if self.project.config.get('DROPBOX_CURSOR'):
+            return True
+        self.project.log("exception", "No previous Dropbox acquisition to continue from, running a full acquisition", "warning", True)
+        return False
+
+    def _log_change(self, path, action):
+        # Deleted files are only recorded, whatever was acquired before stays untouched
+        self.project.log("transaction", "Change: {} {}".format(action, path), "info", True)
+        if self.change_log:
+            with open(self.change_log, 'a') as log:
+                log.write('"{}","{}","{}"\n'.format(Common.utc_get_datetime_as_string(), path, action))
+
+    def _queue_files(self, files, d):
+        self._add_metadata_rows([f for f in files if not f.get('is_deleted')])
+        for file in files:
+            if file.get('is_deleted'):
+                self._log_change(file['path'], "removed")
+                continue
             self.project.log("transaction", "Calculating " + file['path'], "info", True)
 
             if file['is_dir'] == False:
@@ -79,26 +138,35 @@ class Dropbox(OnlineStorage.OnlineStorage):
                     self.file_size_bytes += int(file['bytes'])
 
                 save_metadata_path = Common.assert_path(os.path.normpath(os.path.join(os.path.join(self.project.project_folders['metadata'], parentmap), filetitle + ".json")), self.project)
+                # After a reset every file is listed again, only those that differ from what was acquired are changes
+                if self.change_log and not (self.reset and self._is_acquired(file)):
+                    self._log_change(file['path'], "modified" if save_metadata_path and os.path.isfile(save_metadata_path) else "added")
                 if save_metadata_path:
                     self.project.log("transaction", "Queueing {} for download...".format(orig), "info", True)
-                    d.put(Downloader.DownloadSlip(metadata_download_uri, file, save_metadata_path, 'path'))
+                    d.put(Downloader.DownloadSlip(metadata_download_uri, file, save_metadata_path, 'path', metadata=True))
 
                 if self.project.args.mode == "full":
                     save_download_path = Common.assert_path(os.path.normpath(os.path.join(os.path.join(self.project.project_folders['data'], parentmap), filetitle)), self.project)
-                    if save_download_path:
+                    if save_download_path and self.project.manifest.is_current(save_download_path, None, file.get('rev')):
+                        Metrics.incr("files_skipped")
+                        self.project.log("exception", "Manifest matches local file for {} ... Skipping download".format(orig), "warning")
+                    elif save_download_path:
+                        self.project.manifest.track(save_download_path, file['path'], file['path'], file.get('bytes'), None, file.get('rev'))
                         self.project.log("transaction", "Queueing {} for download...".format(orig), "info", True)
-                        d.put(Downloader.DownloadSlip(download_uri, file, save_download_path, 'path'))
+                        d.put(Downloader.DownloadSlip(download_uri, file, save_download_path, 'path', file.get('bytes'),
+                                                      modified=Common.parse_timestamp(file.get('modified'))))
 
-        self.project.log("transaction", "Total size of files to be acquired is {}".format(Common.sizeof_fmt(self.file_size_bytes, "B")), "highlight", True)
-        if self.project.args.prompt:
-            IO.get("Press ENTER to begin acquisition...")
+    def _is_acquired(self, file):
+        paths = self.project.manifest.local_paths(file['path'])
+        return bool(paths) and all(self.project.manifest.is_current(p, None, file.get('rev')) for p in paths)
 
-        d.start()
-        d.wait_for_complete()
-        d2 = datetime.now()
-        delt = d2 - d1
-
-        self.project.log("transaction", "Acquisition completed in {}".format(str(delt)), "highlight", True)
+    def _log_removed(self):
+        # A reset listing has no entries for deleted files, whatever was acquired before and isn't
+        # listed anymore was removed
+        listed = set(f['path'].lower() for f in self.files if not f.get('is_deleted'))
+        for remote_id in sorted(self.project.manifest.remote_ids()):
+            if remote_id.lower() not in listed:
+                self._log_change(remote_id, "removed")
 
     def _get_parent_mapping(self, file):
         # Nothing difficult about this one.
@@ -117,22 +185,36 @@ class Dropbox(OnlineStorage.OnlineStorage):
         else:
             return None
 
-    def initialize_items(self):
+    def initialize_items(self, on_items=None, cursor=None):
         self.files = []
         self.project.log("transaction", "API Endpoint is " + self.oauth_provider.config['API_ENDPOINT'], "info", True)
         link = self.oauth_provider.config['API_ENDPOINT'] + '/delta'
-        self._build_fs(link)
+        self._build_fs(link, on_items, cursor)
+
+    def _build_fs(self, link, on_items=None, cursor=None):
+        paginator = Paginator.Paginator(self.project, "dropbox_delta", lambda cursor: self._get_page(link, cursor), cursor)
+        for items in paginator.pages():
+            self.files.extend(items)
+            if on_items:
+                on_items(items)
 
-    def _build_fs(self, link, cursor = None):
+    def _get_page(self, link, cursor):
         self.project.log("transaction", "Calculating total dropbox items...", "info", True)
         if cursor:
             response = Common.webrequest(link, self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept, urllib.parse.urlencode({'cursor': cursor}))
         else:
             response = Common.webrequest(link, self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept, "")
         json_response = json.loads(response)
-        has_more = json_response['has_more']
-        cursor = json_response['cursor']
-        for item in json_response['entries']:
-            self.files.append(item[1])
-        if has_more:
-            self._build_fs(link, cursor)
+        if json_response.get('reset') and cursor:
+            self.reset = True
+            # The old cursor is useless now, an interrupted run must not go back to it
+            self.project.save("DROPBOX_CURSOR", "")
+            self.project.log("exception", "Dropbox reset the delta cursor, every file is listed again and compared with what was acquired before", "warning", True)
+        items = []
+        for path, metadata in json_response['entries']:
+            if metadata:
+                items.append(metadata)
+            else:
+                items.append({'path': path, 'is_deleted': True})
+        self.cursor = json_response['cursor']
+        return items, json_response['cursor'] if json_response['has_more'] else None
@@ -0,0 +1,213 @@
+__author__ = 'aurcioli'
+import functools
+import http.client
+import io
+import re
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import uuid
+
+from downloader import Downloader
+from downloader import RateControl
+from metrics import Metrics
+
+# Requests sent together in one batch (see --batch-size). GMail takes up to 100, but batches of
+# more than 50 get rate limited.
+BATCH_SIZE = 50
+MAX_BATCH_SIZE = 100
+# Messages bigger than this (in bytes) are fetched on their own, each part of a batch response is
+# held in memory while it is stored
+LARGE_MESSAGE = 256 * 1024
+# Batch responses are spooled to disk once they get bigger than this, messages listed without their
+# size are batched too and a batch of them can be of any size
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def batch_url(api_endpoint):
+    # https://www.googleapis.com/gmail/v1 -> https://www.googleapis.com/batch/gmail/v1
+    parts = urllib.parse.urlsplit(api_endpoint)
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, "/batch" + parts.path.rstrip('/'), "", ""))
+
+
+def iter_parts(fp):
+    # (content id, status, reason, headers, body) of each part of a multipart/mixed response, read
+    # from fp one part at a time. The boundary is taken from the body, not every engine hands the
+    # response headers to callbacks.
+    line = fp.readline()
+    while line:
+        match = re.match(rb'^--(\S+?)\r?\n?$', line)
+        if match is not None:
+            break
+        line = fp.readline()
+    else:
+        raise http.client.HTTPException("Batch response has no parts")
+    delimiter = b'--' + match.group(1)
+    count = 0
+    while not line.rstrip().endswith(delimiter + b'--'):
+        head = []
+        line = fp.readline()
+        while line and not line.strip():
+            line = fp.readline()
+        while line.strip():
+            head.append(line)
+            line = fp.readline()
+        status_line = fp.readline().split(None, 2)
+        if not status_line:
+            raise http.client.IncompleteRead(b'')
+        headers = http.client.parse_headers(fp)
+        body = []
+        line = fp.readline()
+        while line and not line.startswith(delimiter):
+            body.append(line)
+            line = fp.readline()
+        if not line:
+            raise http.client.IncompleteRead(b''.join(body))
+        data = b''.join(body)
+        # The line break before the next boundary belongs to the boundary
+        if data.endswith(b'\r\n'):
+            data = data[:-2]
+        elif data.endswith(b'\n'):
+            data = data[:-1]
+        content_id = re.search(rb'^Content-ID:\s*<(?:response-)?([^>]*)>', b''.join(head), re.MULTILINE | re.IGNORECASE)
+        reason = status_line[2].decode('latin-1').strip() if len(status_line) > 2 else ""
+        key = content_id.group(1).decode('latin-1') if content_id else "item{}".format(count)
+        count += 1
+        yield key, int(status_line[1]), reason, headers, data
+
+
+def parse_response(body):
+    # {content id: (status, reason, headers, body)} of the parts of a multipart/mixed response
+    return {key: part for key, *part in iter_parts(io.BytesIO(body))}
+
+
+class BatchFailed(http.client.HTTPException):
+    pass
+
+
+class BatchSlip(Downloader.DownloadSlip):
+    # Several GETs sent as one multipart/mixed POST to the batch endpoint. Each part carries the
+    # index of its slip as Content-ID, the response to it comes back with the same one.
+
+    def __init__(self, url, slips):
+        super(BatchSlip, self).__init__(url, {'id': ""}, "", 'id', metadata=all(slip.metadata for slip in slips))
+        self.set_slips(slips)
+
+    def set_slips(self, slips):
+        self.slips = slips
+        self.item['id'] = "batch of {} requests".format(len(slips))
+        boundary = "batch_" + uuid.uuid4().hex
+        self.content_type = "multipart/mixed; boundary=" + boundary
+        lines = []
+        for i, slip in enumerate(slips):
+            parts = urllib.parse.urlsplit(slip.url)
+            path = parts.path + ("?" + parts.query if parts.query else "")
+            lines += ["--" + boundary, "Content-Type: application/http", "Content-ID: <item{}>".format(i), "", "GET " + path, ""]
+        lines.append("--" + boundary + "--")
+        self.data = "\r\n".join(lines) + "\r\n"
+
+
+class Batcher:
+    # Collects the slips put into a stage and puts them in as BatchSlips of up to size requests.
+    # Whatever is left in a batch is put in by flush. The storage callback of the stage has to be
+    # wrapped by storage_callback to split batch responses up again.
+
+    def __init__(self, project, url, size=BATCH_SIZE):
+        self.project = project
+        self.url = url
+        self.size = size
+        self.stage = None
+        self.slips = []
+        self.lock = threading.Lock()
+
+    def put(self, slip):
+        if self.size <= 1:
+            self.stage.put(slip)
+            return
+        with self.lock:
+            self.slips.append(slip)
+            if len(self.slips) < self.size:
+                return
+            slips, self.slips = self.slips, []
+        self._put_batch(slips)
+
+    def flush(self):
+        with self.lock:
+            slips, self.slips = self.slips, []
+        if slips:
+            self._put_batch(slips)
+
+    def _put_batch(self, slips):
+        if len(slips) == 1:
+            self.stage.put(slips[0])
+            return
+        Metrics.incr("batched_requests", len(slips))
+        self.stage.put(BatchSlip(self.url, slips))
+
+    def storage_callback(self, callback, after=None):
+        # Each part of a batch response is handed to callback with the slip it was asked for. Parts
+        # that were throttled or failed on the server are left in the slip and raised as the error
+        # of the whole, so the downloader retries them like any other slip. after runs once per
+        # response, once all of its parts are stored.
+        @functools.wraps(callback)
+        def store(data, slip):
+            try:
+                if isinstance(slip, BatchSlip):
+                    self._store_batch(callback, data, slip)
+                else:
+                    callback(data, slip)
+            finally:
+                if after is not None:
+                    after()
+        return store
+
+    def _store_batch(self, callback, data, slip):
+        # The response is spooled first, only the part being stored is held in memory
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            shutil.copyfileobj(data, spool)
+            spool.seek(0)
+            self._store_parts(callback, spool, slip)
+
+    def _store_parts(self, callback, fp, slip):
+        slips = {"item{}".format(i): part_slip for i, part_slip in enumerate(slip.slips)}
+        failed = []
+        throttled = None
+        problem = "no response"
+        try:
+            for key, status, reason, headers, body in iter_parts(fp):
+                part_slip = slips.pop(key, None)
+                if part_slip is None:
+                    continue
+                if status < 300:
+                    try:
+                        callback(io.BytesIO(body), part_slip)
+                    except (http.client.HTTPException, OSError) as err:
+                        # Only this part is tried again, the others are stored already
+                        failed.append(part_slip)
+                        problem = repr(err)
+                    except Exception as err:
+                        # A response we can't store won't get better by asking again, the rest still counts
+                        self.project.log("exception", "Could not store {} - {}".format(part_slip.item["id"], repr(err)), "critical", True)
+                    continue
+                err = urllib.error.HTTPError(part_slip.url, status, reason, headers, io.BytesIO(body))
+                if RateControl.is_throttled(err):
+                    failed.append(part_slip)
+                    throttled = err
+                elif status == 401 or status >= 500:
+                    failed.append(part_slip)
+                    problem = "HTTPError {}".format(status)
+                else:
+                    self.project.log("exception", "{} failed to download - HTTPError {}".format(part_slip.item[part_slip.filename_key], status), "warning")
+        except http.client.HTTPException as err:
+            # A response that breaks off still has the parts before
+            problem = repr(err)
+        # Parts missing from the response are asked for again
+        failed += slips.values()
+        if not failed:
+            return
+        slip.set_slips(failed)
+        if throttled is not None:
+            raise throttled
+        raise BatchFailed("{} requests of the batch failed - {}".format(len(failed), problem))
@@ -3,17 +3,30 @@ __author__ = 'aurcioli'
 import json
 from datetime import datetime
 import os
+import logging
 import base64
 import mailbox
 import email
+import urllib.error
 
 from onlinestorage import OnlineStorage
 from common import Common
+from common import Paginator
 from downloader import Downloader
+from metrics import Metrics
+from gmail import Batch
+from gmail import MboxWriter
 from oi.IO import IO
+from oi import LogWriter
 from oauth2providers import OAuth2Providers
 import time
 
+# Ways of listing the mailbox, see --gmail-listing
+LISTINGS = ["threads", "messages"]
+# Most messages GMail lists per page
+MESSAGE_PAGE_SIZE = 500
+
+
 class GMail(OnlineStorage.OnlineStorage):
     threads = []
     verification = []
@@ -27,85 +40,224 @@ class GMail(OnlineStorage.OnlineStorage):
     def __init__(self, project):
         self.project = project
         self.oauth_provider = OAuth2Providers.OAuth2Provider(self, "google", "refresh_token")
-        self.project.save("API_ENDPOINT", 'https://www.googleapis.com/gmail/v1')
+        # A project may be pointed at another endpoint, such as a local mock of the API
+        if not self.project.config.get("API_ENDPOINT"):
+            self.project.save("API_ENDPOINT", 'https://www.googleapis.com/gmail/v1')
         self.project.save("OAUTH_SCOPE", 'https://www.googleapis.com/auth/gmail.readonly')
         self.files = []
         self.file_size_bytes = 0
+        self.history_id = None
         super(GMail, self).__init__(self, project.name)
 
     def sync(self):
         d1 = datetime.now()
+        # With --prompt everything has to be listed before anything is downloaded,
+        # otherwise every stage runs while the mailbox is still being listed.
+        streaming = not self.project.args.prompt
+        incremental = self._can_acquire_incrementally()
+        maxsize = Downloader.STREAM_QUEUE_SIZE if streaming else 0
+        # Listing messages gives their ids right away, listing threads needs every thread fetched
+        # first but also tells the size of the mail up front
+        by_message = getattr(self.project.args, 'gmail_listing', "threads") == "messages"
+        by_thread = self.project.args.mode == "full" and not by_message
         self.d = Downloader.Downloader
         self.content_downloader = Downloader.Downloader
-        self.meta_downloader = Downloader.Downloader(self.project, self.oauth_provider.http_intercept, self._save_metadata, self.oauth_provider.get_auth_header, self.project.threads)
+        # Thread and message GETs are sent in batches, each stage gets them through its Batcher
+        self.meta_batches = self._get_batcher(self._save_metadata, maxsize)
+        self.meta_downloader = self.meta_batches.stage
 
         if self.project.args.mode == "full":
             self.project.log("transaction", "Full acquisition initiated", "info", True)
-            self.d = Downloader.Downloader(self.project, self.oauth_provider.http_intercept, self._redirect_messages_to_save, self.oauth_provider.get_auth_header, self.project.threads)
-            self.content_downloader = Downloader.Downloader(self.project, self.oauth_provider.http_intercept, self._save_raw_mail, self.oauth_provider.get_auth_header, self.project.threads)
+            self.message_batches = self._get_batcher(self._save_raw_mail, maxsize)
+            self.content_downloader = self.message_batches.stage
+        if by_thread:
+            # Messages of the threads in a batch are put in as soon as the whole batch is stored
+            self.thread_batches = self._get_batcher(self._redirect_messages_to_save, maxsize, self.message_batches.flush)
+            self.d = self.thread_batches.stage
+            # Messages of a thread are queued as soon as the thread has been fetched
+            self.d.feeds(self.content_downloader)
+        if self.project.args.mode == "full":
+            self.mbox_dir = os.path.join(self.project.acquisition_dir, "mbox")
+            os.makedirs(self.mbox_dir, exist_ok=True)
+            self.mbox_writer = self.content_downloader.feeds(MboxWriter.MboxWriter(self.project, self.mbox_dir))
+            self.mbox_writer.start()
         else:
             self.project.log("transaction", "Metadata acquisition initiated", "info", True)
 
-        self.initialize_items()
-        cnt = len(self.threads)
-        self.project.log("transaction", "Total threads queued for acquisition: {}".format(cnt), "info", True)
         self.metadata()
-
-        for thread in self.threads:
-            self.project.log("transaction", 'Calculating "{}"'.format(thread['snippet']), "info", True)
-            savepath = ""
+        if not incremental:
+            # Taken before listing so nothing that arrives while we list is missed next time
+            self.history_id = self._get_history_id()
+        if streaming:
+            self.meta_downloader.start()
+            if by_thread:
+                self.d.start()
             if self.project.args.mode == "full":
-                download_uri = self.get_thread_uri(thread, "minimal")
-                self.d.put(Downloader.DownloadSlip(download_uri, thread, savepath, 'id'))
-
-            meta_uri = self.get_thread_uri(thread, "metadata")
-            self.meta_downloader.put(Downloader.DownloadSlip(meta_uri, thread, savepath, 'id'))
-
+                self.content_downloader.start()
+        if incremental:
+            try:
+                self.initialize_history()
+            except urllib.error.HTTPError as err:
+                if err.code != 404:
+                    raise
+                # GMail only keeps history for so long, past that there is nothing to continue from
+                self.project.log("exception", "GMail history since {} is no longer available, running a full acquisition".format(self.history_id), "warning", True)
+                incremental = False
+                self.history_id = self._get_history_id()
+        if not incremental and by_message:
+            if streaming:
+                self.initialize_messages(self._queue_messages)
+            else:
+                self.initialize_messages()
+                self._queue_messages(self.messages)
+        elif not incremental:
+            if streaming:
+                self.initialize_items(self._queue_threads)
+            else:
+                self.initialize_items()
+                self._queue_threads(self.threads)
+        # Listing is over, from here on only the thread stage puts anything into the message stage
+        self.meta_batches.flush()
+        self.meta_downloader.close()
+        if by_thread:
+            self.thread_batches.flush()
+            self.d.close()
         if self.project.args.mode == "full":
-            self.d.start()
+            self.message_batches.flush()
+            self.content_downloader.close()
+        if by_message and not incremental:
+            self.project.log("transaction", "Total messages queued for acquisition: {}".format(len(self.messages)), "info", True)
+        else:
+            cnt = len(self.threads)
+            self.project.log("transaction", "Total threads queued for acquisition: {}".format(cnt), "info", True)
+
+        if by_thread:
+            if not streaming:
+                self.d.start()
             self.d.wait_for_complete()
             self.project.log("transaction", "Total size of mail to be acquired is {}".format(Common.sizeof_fmt(self.file_size_bytes,"B")), "highlight", True)
-            self.mbox_dir = os.path.join(self.project.acquisition_dir, "mbox")
-            os.makedirs(self.mbox_dir, exist_ok=True)
 
         if self.project.args.prompt:
             IO.get("Press ENTER to begin acquisition...")
 
         if self.project.args.mode == "full":
-            self.content_downloader.start()
+            if not streaming:
+                self.content_downloader.start()
             self.content_downloader.wait_for_complete()
+            self.mbox_writer.wait_for_complete()
 
-        self.meta_downloader.start()
+        if not streaming:
+            self.meta_downloader.start()
         self.meta_downloader.wait_for_complete()
+        if self.project.args.mode == "full" and not self.project.shutdown_signal and self.history_id:
+            self.project.save("GMAIL_HISTORY_ID", self.history_id)
 
         d2 = datetime.now()
         delt = d2 - d1
         self.project.log("transaction", "Acquisition completed in {}".format(str(delt)), "highlight", True)
 
+    def _get_batcher(self, storage_callback, maxsize, after=None):
+        size = getattr(self.project.args, 'batch_size', Batch.BATCH_SIZE)
+        batcher = Batch.Batcher(self.project, Batch.batch_url(self.project.config['API_ENDPOINT']), size)
+        batcher.stage = Downloader.get_downloader(self.project, self.oauth_provider.http_intercept, batcher.storage_callback(storage_callback, after),
+                                                  self.oauth_provider.get_auth_header, self.project.threads, maxsize)
+        return batcher
+
+    def _queue_threads(self, threads):
+        for thread in threads:
+            self.project.log("transaction", 'Calculating "{}"'.format(thread['snippet']), "info", True)
+            savepath = ""
+            if self.project.args.mode == "full":
+                download_uri = self.get_thread_uri(thread, "minimal")
+                self.thread_batches.put(Downloader.DownloadSlip(download_uri, thread, savepath, 'id', metadata=True))
+
+            meta_uri = self.get_thread_uri(thread, "metadata")
+            self.meta_batches.put(Downloader.DownloadSlip(meta_uri, thread, savepath, 'id', metadata=True))
+
+    def _queue_messages(self, messages):
+        # Messages listed without their labels or size, GMail tells them when they are downloaded
+        for message in messages:
+            if self.project.args.mode == "full":
+                self._queue_message(message, "id")
+            if message['threadId'] not in self.listed_threads:
+                self.listed_threads.add(message['threadId'])
+                thread = {'id': message['threadId']}
+                self.meta_batches.put(Downloader.DownloadSlip(self.get_thread_uri(thread, "metadata"), thread, "", 'id', metadata=True))
+
+    def _can_acquire_incrementally(self):
+        if not getattr(self.project.args, 'incremental', False):
+            return False
+        if self.project.config.get('GMAIL_HISTORY_ID'):
+            return True
+        self.project.log("exception", "No previous GMail acquisition to continue from, running a full acquisition", "warning", True)
+        return False
+
+    def _get_history_id(self):
+        response = Common.webrequest(Common.joinurl(self.project.config['API_ENDPOINT'], "users/me/profile"), self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept)
+        return json.loads(response)['historyId']
+
+    def initialize_history(self):
+        # Everything that happened to the mailbox since the last acquisition. New messages are
+        # downloaded and appended to the label mboxes, label changes and deletions only get logged.
+        self.history_id = self.project.config['GMAIL_HISTORY_ID']
+        self.project.log("transaction", "Fetching GMail history since {}".format(self.history_id), "info", True)
+        self.change_log = os.path.join(self.project.working_dir, Common.timely_filename("changes", ".csv"))
+        with open(self.change_log, 'w') as log:
+            log.write("TIME_PROCESSED,HISTORY_ID,MESSAGE_ID,THREAD_ID,ACTION,LABELS\n")
+
+        link = Common.joinurl(self.project.config['API_ENDPOINT'], "users/me/history?startHistoryId={}&maxResults=500".format(self.history_id))
+        paginator = Paginator.Paginator(self.project, "gmail_history", lambda token: self._get_history_page(link, token))
+        queued_threads = set()
+        queued_messages = set()
+        for records in paginator.pages():
+            with open(self.change_log, 'a') as log:
+                for record in records:
+                    for change in record.get('messagesAdded', []):
+                        message = change['message']
+                        self._log_change(log, record, message, "added", message.get('labelIds', []))
+                        if self.project.args.mode == "full" and message['id'] not in queued_messages:
+                            queued_messages.add(message['id'])
+                            self._queue_message(message, "id")
+                        if message['threadId'] not in queued_threads:
+                            queued_threads.add(message['threadId'])
+                            thread = {'id': message['threadId']}
+                            self.meta_batches.put(Downloader.DownloadSlip(self.get_thread_uri(thread, "metadata"), thread, "", 'id', metadata=True))
+                    for change in record.get('messagesDeleted', []):
+                        self._log_change(log, record, change['message'], "removed", change['message'].get('labelIds', []))
+                    for change in record.get('labelsAdded', []):
+                        self._log_change(log, record, change['message'], "labels added", change.get('labelIds', []))
+                    for change in record.get('labelsRemoved', []):
+                        self._log_change(log, record, change['message'], "labels removed", change.get('labelIds', []))
+        self.project.log("transaction", "{} new messages in {} threads since the last acquisition".format(len(queued_messages), len(queued_threads)), "highlight", True)
+
+    def _get_history_page(self, link, page_token):
+        if page_token:
+            link = "{}&pageToken={}".format(link, page_token)
+        response = Common.webrequest(link, self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept)
+        json_response = json.loads(response)
+        if 'historyId' in json_response:
+            self.history_id = json_response['historyId']
+        return json_response.get('history', []), json_response.get('nextPageToken')
+
+    def _log_change(self, log, record, message, action, labels):
+        log.write('"{date}","{hid}","{mid}","{tid}","{action}","{labels}"\n'.format(date=Common.utc_get_datetime_as_string(), hid=record['id'], mid=message['id'],
+                                                                                tid=message.get('threadId', ''), action=action, labels=",".join(labels)))
+
     def _save_metadata(self, data, slip):
         data = data.read().decode('utf-8')
         thread = json.loads(data)
-        f = open(self.metadata_file, 'ab')
+        metadata_dir = self.project.project_folders['metadata']
+        thread_paths = []
         for message in thread['messages']:
+            message_paths = []
             for label in message['labelIds']:
-                label_dir = os.path.join(self.project.project_folders['metadata'], label)
-                thread_dir = os.path.join(label_dir, thread['id'])
-                message_dir = os.path.join(thread_dir, message['id'])
-                msg_metadata_path = os.path.join(message_dir, message['id'] + ".json")
-                msg_metadata_path = Common.assert_path(msg_metadata_path, self.project)
-                # Save metadata of each message individually, inside label/thread/message directory
-                if msg_metadata_path:
-                    os.makedirs(message_dir, exist_ok=True)
-                    self.project.savedata(json.dumps(message, sort_keys=True, indent=4), msg_metadata_path, False)
-                    self.project.log("transaction", "Saving metadata to {}".format(msg_metadata_path), "info", True)
-                thread_metadata_path = os.path.join(thread_dir, thread['id'] + ".json")
-
-                # Save metadata of each thread individually inside label/thread directory
-                thread_metadata_path = Common.assert_path(thread_metadata_path, self.project)
-                if thread_metadata_path:
-                    os.makedirs(thread_dir, exist_ok=True)
-                    self.project.savedata(json.dumps(thread, sort_keys=True, indent=4), thread_metadata_path, False)
-                    self.project.log("transaction", "Saving metadata to {}".format(thread_metadata_path), "info", True)
+                # Metadata of each message inside label/thread/message, of each thread inside label/thread
+                thread_dir = os.path.join(metadata_dir, label, thread['id'])
+                message_paths.append(os.path.join(thread_dir, message['id'], message['id'] + ".json"))
+                thread_path = os.path.join(thread_dir, thread['id'] + ".json")
+                if thread_path not in thread_paths:
+                    thread_paths.append(thread_path)
+            self._save_json(message, message_paths)
             headers = message['payload']['headers']
             label_list = ",".join(message['labelIds'])
             internal_date = message['internalDate']
@@ -116,8 +268,17 @@ class GMail(OnlineStorage.OnlineStorage):
             header_subject = 'N/A' if not self.extract_header_value(headers, 'Subject') else self.extract_header_value(headers, 'Subject')
             snippet = message['snippet']
             thread_id = thread['id']
-            f.write('"{id}","{internaldate}","{labels}","{headerdate}","{to}","{xfrom}","{subject}","{snippet}","{threadid}"{sep}'.format(id=message['id'],internaldate=internal_date,labels=label_list,headerdate=header_date,to=header_to,xfrom=header_from,subject=header_subject,snippet=snippet,threadid=thread_id,sep=os.linesep).encode('utf-8'))
-        f.close()
+            self.message_list.info('"{id}","{internaldate}","{labels}","{headerdate}","{to}","{xfrom}","{subject}","{snippet}","{threadid}"'.format(id=message['id'],internaldate=internal_date,labels=label_list,headerdate=header_date,to=header_to,xfrom=header_from,subject=header_subject,snippet=snippet,threadid=thread_id))
+        self._save_json(thread, thread_paths)
+
+    def _save_json(self, item, paths):
+        # Serialized and written once, the same file is linked into the directory of every label
+        paths = [p for p in (Common.assert_path(p, self.project) for p in paths) if p]
+        if not paths:
+            return
+        self.project.savedata_linked(json.dumps(item, sort_keys=True, indent=4), paths)
+        for path in paths:
+            self.project.log("transaction", "Saving metadata to {}".format(path), "info", True)
 
     def extract_header_value(self, l, name):
         for kv in l:
@@ -131,16 +292,19 @@ class GMail(OnlineStorage.OnlineStorage):
         msg_data = base64.urlsafe_b64decode(msg_data).decode('utf-8')
         labels = msg["labelIds"]
         data_dir = self.project.project_folders["data"]
+        mbox_msg = email.message_from_bytes(msg_data.encode(), mailbox.mboxMessage)
+        entry = MboxWriter.mbox_entry(mbox_msg)
         for label in labels:
-            mbox = mailbox.mbox(os.path.join(self.mbox_dir, label))
-            mbox_msg = email.message_from_bytes(msg_data.encode(), mailbox.mboxMessage)
-            mbox.add(mbox_msg)
+            self.mbox_writer.put(label, msg["id"], entry)
             label_path = os.path.join(data_dir, label)
             save_path = os.path.join(label_path, slip.savepath)
             save_path = Common.assert_path(save_path, self.project)
             if save_path:
                 if not os.path.isdir(os.path.dirname(save_path)):
                     os.makedirs(os.path.dirname(save_path), exist_ok=True)
+                if 'labelIds' not in slip.item:
+                    # Listed by message, its labels weren't known when it was queued
+                    self.project.manifest.track(self._message_path(label, slip.savepath), msg["id"], os.path.join(label, slip.savepath), msg.get("sizeEstimate"))
                 self.project.savedata(msg_data, save_path, False)
                 self.project.log("transaction", "Saved file to " + save_path, "info", True)
 
@@ -156,20 +320,47 @@ class GMail(OnlineStorage.OnlineStorage):
                         with open(att_path, 'wb') as f:
                             f.write(data)
                         self.project.log("transaction", "Saved attachment to " + save_path, "info", True)
-            mbox.flush()
 
     def _redirect_messages_to_save(self, data, slip):
         data = data.read().decode()
         json_data = json.loads(data)
         if "messages" in json_data:
             for message in json_data["messages"]:
-                download_uri = self.get_message_uri(message)
-                _filetitle = message["id"] + ".txt"
-                filetitle = Common.safe_file_name(_filetitle)
                 self.file_size_bytes += int(message["sizeEstimate"])
-                if filetitle != filetitle:
-                    self.project.log("exception", "Normalized '{}' to '{}'".format(_filetitle, filetitle),"warning", True)
-                self.content_downloader.put(Downloader.DownloadSlip(download_uri, message, filetitle, "snippet"))
+                self._queue_message(message, "snippet")
+
+    def _queue_message(self, message, fname_key):
+        download_uri = self.get_message_uri(message)
+        _filetitle = message["id"] + ".txt"
+        filetitle = Common.safe_file_name(_filetitle)
+        if filetitle != _filetitle:
+            self.project.log("exception", "Normalized '{}' to '{}'".format(_filetitle, filetitle),"warning", True)
+        # Messages never change, one that was saved under all of its labels already is done
+        labels = message.get('labelIds')
+        if labels is None:
+            # Listed without its labels, the manifest knows where it was saved before
+            save_paths = self.project.manifest.local_paths(message["id"])
+            saved_labels = [os.path.relpath(os.path.dirname(p), self.project.project_folders["data"]) for p in save_paths]
+        else:
+            save_paths = [self._message_path(label, filetitle) for label in labels]
+            saved_labels = labels
+        if save_paths and all(self.project.manifest.is_current(p) for p in save_paths) and \
+                all(self.mbox_writer.appended(label, message["id"]) for label in saved_labels):
+            Metrics.incr("files_skipped")
+            self.project.log("exception", "Manifest matches local files for {} ... Skipping download".format(message["id"]), "warning")
+            return
+        for label, save_path in zip(labels or [], save_paths):
+            self.project.manifest.track(save_path, message["id"], os.path.join(label, filetitle), message.get("sizeEstimate"))
+        slip = Downloader.DownloadSlip(download_uri, message, filetitle, fname_key,
+                                       modified=int(message["internalDate"]) / 1000 if "internalDate" in message else None)
+        # Messages listed without their size are batched too, batch responses are spooled to disk
+        if int(message.get("sizeEstimate", 0)) > Batch.LARGE_MESSAGE:
+            self.content_downloader.put(slip)
+        else:
+            self.message_batches.put(slip)
+
+    def _message_path(self, label, filetitle):
+        return os.path.abspath(os.path.join(self.project.project_folders["data"], label, filetitle))
 
     def get_thread_uri(self, thread, format):
         id = thread['id']
@@ -186,28 +377,53 @@ class GMail(OnlineStorage.OnlineStorage):
         with open(msg_list_path, 'w') as f:
             f.write("id,internalDate,labels,headerDate,To,From,Subject,snippet,threadId\n")
         self.metadata_file = msg_list_path
+        # Rows are appended in batches by the thread that writes the project logs
+        self.message_list = logging.getLogger(self.project.name + "_message_list")
+        self.message_list.setLevel(logging.INFO)
+        self.message_list.propagate = False
+        handler = LogWriter.BatchedFileHandler(msg_list_path, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.project.log_writer.attach(self.message_list, handler)
 
-    def initialize_items(self):
+    def initialize_items(self, on_items=None):
         self.threads = []
         self.project.log("transaction", "API Endpoint is {}".format(self.project.config['API_ENDPOINT']), "info", True)
-        self._build_fs(Common.joinurl(self.project.config['API_ENDPOINT'], "users/me/threads?userId=me&includeSpamTrash=true"))
+        self._build_fs(Common.joinurl(self.project.config['API_ENDPOINT'], "users/me/threads?userId=me&includeSpamTrash=true"), on_items)
 
-    def _build_fs(self, link):
-        self.project.log("transaction", "Calculating total GMail items...", "info", True)
+    def initialize_messages(self, on_items=None):
+        self.messages = []
+        self.listed_threads = set()
+        self.project.log("transaction", "API Endpoint is {}".format(self.project.config['API_ENDPOINT']), "info", True)
+        link = Common.joinurl(self.project.config['API_ENDPOINT'], "users/me/messages?includeSpamTrash=true&maxResults={}".format(MESSAGE_PAGE_SIZE))
+        paginator = Paginator.Paginator(self.project, "gmail_messages", lambda token: self._get_message_page(link, token))
+        for messages in paginator.pages():
+            self.messages.extend(messages)
+            if on_items:
+                on_items(messages)
+
+    def _get_message_page(self, link, page_token):
+        self.project.log("transaction", "Listing GMail messages...", "info", True)
+        if page_token:
+            link = "{}&pageToken={}".format(link, page_token)
         response = Common.webrequest(link, self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept)
         json_response = json.loads(response)
+        return json_response.get('messages', []), json_response.get('nextPageToken')
 
-        if 'nextPageToken' in json_response:
-            threads = json_response['threads']
-            self._add_items_to_threads(threads)
-            next_url = Common.joinurl(self.project.config['API_ENDPOINT'], "users/me/threads?userId=me&includeSpamTrash=true&pageToken={}".format(json_response['nextPageToken']))
-            self._build_fs(next_url)
-        else:
-            items = json_response['threads']
-            self._add_items_to_threads(items)
+    def _build_fs(self, link, on_items=None):
+        paginator = Paginator.Paginator(self.project, "gmail_threads", lambda token: self._get_page(link, token))
+        for threads in paginator.pages():
+            self._add_items_to_threads(threads, on_items)
 
-    def _add_items_to_threads(self, items):
+    def _get_page(self, link, page_token):
+        self.project.log("transaction", "Calculating total GMail items...", "info", True)
+        if page_token:
+            link = "{}&pageToken={}".format(link, page_token)
+        response = Common.webrequest(link, self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept)
+        json_response = json.loads(response)
+        return json_response.get('threads', []), json_response.get('nextPageToken')
+
+    def _add_items_to_threads(self, items, on_items=None):
         for i in items:
             self.threads.append(i)
-
-
+        if on_items:
+            on_items(items)
\ No newline at end of file
@@ -0,0 +1,168 @@
+__author__ = 'aurcioli'
+import csv
+import email.generator
+import io
+import os
+import queue
+import threading
+import time
+
+from downloader import Pipeline
+
+# Seconds between flushes of the mbox files and their indexes while messages keep coming
+FLUSH_INTERVAL = 2.0
+WRITE_BUFFER = 1024 * 1024
+INDEX_SUFFIX = ".index.csv"
+
+
+def mbox_entry(message):
+    # A mailbox.mboxMessage the way mailbox.mbox appends it: From line, message with "From " lines
+    # quoted, blank line. Returns (entry, length of the message without the blank line).
+    buf = io.BytesIO()
+    buf.write(b'From ' + message.get_from().encode('ascii') + b'\n')
+    email.generator.BytesGenerator(buf, mangle_from_=True, maxheaderlen=0).flatten(message)
+    if not buf.getvalue().endswith(b'\n'):
+        buf.write(b'\n')
+    length = buf.tell()
+    buf.write(b'\n')
+    return buf.getvalue(), length
+
+
+def indexed_ids(path):
+    # Ids of the messages the index of the mbox at path has, None if it has to be started over
+    index_path = path + INDEX_SUFFIX
+    # An index without its mbox points at nothing
+    if not os.path.isfile(index_path) or not os.path.isfile(path):
+        return None
+    with open(index_path, 'r', newline='') as f:
+        return {row['MESSAGE_ID'] for row in csv.DictReader(f)}
+
+
+class Label:
+    # The mbox file of one label, kept open for appending, and its index of where every message is
+
+    def __init__(self, path):
+        index_path = path + INDEX_SUFFIX
+        self.ids = indexed_ids(path)
+        new_index = self.ids is None
+        if new_index:
+            self.ids = set()
+        self.mbox = open(path, 'ab', buffering=WRITE_BUFFER)
+        self.index = open(index_path, 'w' if new_index else 'a', newline='')
+        self.writer = csv.writer(self.index)
+        # Index rows of the messages appended since the last flush
+        self.rows = []
+        if new_index:
+            self.writer.writerow(["MESSAGE_ID", "OFFSET", "LENGTH"])
+            self.index.flush()
+
+    def append(self, message_id, entry, length):
+        if message_id in self.ids:
+            return
+        offset = self.mbox.tell()
+        self.mbox.write(entry)
+        self.rows.append([message_id, offset, length])
+        self.ids.add(message_id)
+
+    def flush(self):
+        # Index rows are only written once the messages they point to are on disk
+        self.mbox.flush()
+        os.fsync(self.mbox.fileno())
+        self.writer.writerows(self.rows)
+        self.rows = []
+        self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.mbox.close()
+        self.index.close()
+
+
+class MboxWriter(Pipeline.Stage):
+    # Appends downloaded messages to the mbox file of each of their labels. Only the thread of this
+    # stage writes the files, messages are handed to it through a queue. Every mbox gets a
+    # <label>.index.csv with the offset and length of each message in it, messages already in the
+    # index aren't appended again.
+
+    def __init__(self, project, mbox_dir):
+        self.mbox_dir = mbox_dir
+        self.queue = queue.SimpleQueue()
+        self.labels = {}
+        self.pending = 0
+        self.thread = None
+        # Ids in the indexes as they were on disk when this run started, see appended
+        self.indexed = {}
+        super(MboxWriter, self).__init__(project, "mbox")
+
+    def put(self, label, message_id, entry):
+        with self.cond:
+            self.pending += 1
+        self.queue.put((label, message_id, entry))
+
+    def appended(self, label, message_id):
+        # True if an earlier run appended message_id to the mbox of label. Its .txt file being saved
+        # says nothing about that, the entry may still have been queued here when the run ended.
+        with self.cond:
+            if label not in self.indexed:
+                self.indexed[label] = indexed_ids(os.path.join(self.mbox_dir, label)) or set()
+            return message_id in self.indexed[label]
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.name = "Mbox writer"
+        self.thread.start()
+
+    def depth(self):
+        return self.pending
+
+    def wait_for_complete(self):
+        super(MboxWriter, self).wait_for_complete()
+        self.stop()
+
+    def stop(self):
+        # Whatever was put so far is written before the thread ends
+        self.queue.put(None)
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=FLUSH_INTERVAL)
+                except queue.Empty:
+                    item = False
+                if item is None:
+                    break
+                if item:
+                    self._write(*item)
+                if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                    self._flush()
+                    last_flush = time.monotonic()
+        finally:
+            for label in self.labels.values():
+                label.close()
+            self.labels = {}
+
+    def _write(self, label, message_id, entry):
+        try:
+            if label not in self.labels:
+                self.labels[label] = Label(os.path.join(self.mbox_dir, label))
+            self.labels[label].append(message_id, *entry)
+        except Exception as err:
+            # Only this message is lost, the thread keeps writing the others
+            self.project.log("exception", "Could not append {} to the {} mbox - {}".format(message_id, label, repr(err)), "critical", True)
+        finally:
+            with self.cond:
+                self.pending -= 1
+            self._check_done()
+
+    def _flush(self):
+        for name, label in self.labels.items():
+            try:
+                label.flush()
+            except OSError as err:
+                self.project.log("exception", "Could not write the {} mbox - {}".format(name, repr(err)), "critical", True)
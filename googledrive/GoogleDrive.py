@@ -1,13 +1,17 @@
 import json
 from datetime import datetime
 import os
-import hashlib
+import threading
 
 from onlinestorage import OnlineStorage
 from common import Common
+from common import Paginator
 from downloader import Downloader
+from metrics import Metrics
+from manifest import Manifest
 from oi.IO import IO
 from oauth2providers import OAuth2Providers
+from verification import Verification
 
 
 class GoogleDrive(OnlineStorage.OnlineStorage):
@@ -21,138 +25,176 @@ class GoogleDrive(OnlineStorage.OnlineStorage):
     def __init__(self, project):
         self.project = project
         self.oauth_provider = OAuth2Providers.OAuth2Provider(self,"google", "refresh_token")
-        self.project.save("API_ENDPOINT", 'https://www.googleapis.com/drive/v2')
+        # A project may be pointed at another endpoint, such as tools/mock_drive.py
+        if not self.project.config.get("API_ENDPOINT"):
+            self.project.save("API_ENDPOINT", 'https://www.googleapis.com/drive/v2')
         self.project.save("OAUTH_SCOPE", 'https://www.googleapis.com/auth/drive.readonly')
         self.files = []
+        self.items_by_id = {}
+        self.folder_paths = {}
+        self.title_index = None
         self.file_size_bytes = 0
+        self.staging_dir = os.path.join(self.project.acquisition_dir, "staging")
+        self.staging_lock = threading.Lock()
+        self.staged = {}
+        self.placements = {}
+        self.largest_change_id = None
         super(GoogleDrive, self).__init__(self, project.name)
 
-    def initialize_items(self):
+    def initialize_items(self, on_items=None):
         self.files = []
+        self.items_by_id = {}
+        self.folder_paths = {}
+        self.title_index = None
         self.project.log("transaction", "API Endpoint is " + self.project.config['API_ENDPOINT'], "info", True)
-        self._build_fs(Common.joinurl(self.project.config['API_ENDPOINT'], "files?maxResults=0"))
+        self._build_fs(Common.joinurl(self.project.config['API_ENDPOINT'], "files?maxResults=0"), on_items)
 
     def metadata(self):
         self.project.log("transaction", "Generating metadata CSV File...", "info", True)
-        if not self.files:
-            self.initialize_items()
-
         fname = Common.timely_filename("FileList", ".csv")
-        metadata_file = os.path.join(self.project.working_dir, fname)
-        IO.put("Writing CSV File '{}'".format(metadata_file))
-
-        f = open(metadata_file, "w")
+        self.metadata_file = os.path.join(self.project.working_dir, fname)
+        IO.put("Writing CSV File '{}'".format(self.metadata_file))
 
         columns = ("id,title,fileExtension,fileSize,createdDate,modifiedDate,modifiedByMeDate,md5Checksum,"
                    "kind,version,parents,restricted,hidden,trashed,starred,viewed,markedViewedByMeDate,lastViewedByMeDate,"
                    "lastModifyingUserName,writersCanShare,sharedWithMeDate,sharingUser,sharingUserEmail,ownerNames{}\n")
 
-        f.write(columns)
-        for i in self.files:
-            row2 = []
-            # Data normalization
-            row2.append('None' if 'id' not in i else repr(i['id']))
-            row2.append('None' if 'title' not in i else '"' + i['title'] + '"')
-            row2.append('None' if 'fileExtension' not in i else repr(i['fileExtension']))
-            row2.append('None' if 'fileSize' not in i else i['fileSize'])
-            row2.append('None' if 'createdDate' not in i else i['createdDate'])
-            row2.append('None' if 'modifiedDate' not in i else i['modifiedDate'])
-            row2.append('None' if 'modifiedByMeDate' not in i else i['modifiedByMeDate'])
-            row2.append('None' if 'md5Checksum' not in i else '"' + i['md5Checksum'] + '"')
-            row2.append('None' if 'kind' not in i else repr(i['kind']))
-            row2.append('None' if 'version' not in i else i['version'])
-            if 'parents' not in i or len(i['parents']) == 0:
-                row2.append('None')
-            else:
-                parStr = '"'
-                for p in i['parents']:
-                    parStr = parStr + str(p['id']) + ','
-                parStr = parStr[:len(parStr) - 1]
-                parStr = parStr + '"'
-                row2.append(parStr)
-
-            row2.append('None' if 'labels' not in i else repr(i['labels']['restricted']))
-            row2.append('None' if 'labels' not in i else repr(i['labels']['hidden']))
-            row2.append('None' if 'labels' not in i else repr(i['labels']['trashed']))
-            row2.append('None' if 'labels' not in i else repr(i['labels']['starred']))
-            row2.append('None' if 'labels' not in i else repr(i['labels']['viewed']))
-            row2.append('None' if 'markedViewedByMeDate' not in i else i['markedViewedByMeDate'])
-            row2.append('None' if 'lastViewedByMeDate' not in i else i['lastViewedByMeDate'])
-            row2.append('None' if 'lastModifyingUserName' not in i else '"' + i['lastModifyingUserName'] + '"')
-            row2.append('None' if 'writersCanShare' not in i else i['writersCanShare'])
-            row2.append('None' if 'sharedWithMeDate' not in i else i['sharedWithMeDate'])
-            row2.append('None' if 'sharingUser' not in i else '"' + i['sharingUser']['displayName'] + '"')
-            row2.append('None' if 'sharingUser' not in i else '"' + i['sharingUser']['emailAddress'] + '"')
-            if 'ownerNames' not in i or len(i['ownerNames']) == 0:
-                row2.append('None')
-            else:
-                ownStr = '"'
-                for o in i['ownerNames']:
-                    ownStr = ownStr + str(o) + ','
-                ownStr = ownStr[:len(ownStr) - 1]
-                ownStr = ownStr + '"'
-                row2.append(ownStr)
-
-            rowStr = ""
-            for r in row2:
-                rowStr = rowStr + str(r) + ","
-            rowStr = rowStr[:len(rowStr) - 1]
-            f.write(rowStr + '\n')
-
-        f.close()
-
-    def verify(self):
+        with open(self.metadata_file, "w") as f:
+            f.write(columns)
+
+    def _add_metadata_rows(self, files):
+        with open(self.metadata_file, "a") as f:
+            for i in files:
+                row2 = []
+                # Data normalization
+                row2.append('None' if 'id' not in i else repr(i['id']))
+                row2.append('None' if 'title' not in i else '"' + i['title'] + '"')
+                row2.append('None' if 'fileExtension' not in i else repr(i['fileExtension']))
+                row2.append('None' if 'fileSize' not in i else i['fileSize'])
+                row2.append('None' if 'createdDate' not in i else i['createdDate'])
+                row2.append('None' if 'modifiedDate' not in i else i['modifiedDate'])
+                row2.append('None' if 'modifiedByMeDate' not in i else i['modifiedByMeDate'])
+                row2.append('None' if 'md5Checksum' not in i else '"' + i['md5Checksum'] + '"')
+                row2.append('None' if 'kind' not in i else repr(i['kind']))
+                row2.append('None' if 'version' not in i else i['version'])
+                if 'parents' not in i or len(i['parents']) == 0:
+                    row2.append('None')
+                else:
+                    parStr = '"'
+                    for p in i['parents']:
+                        parStr = parStr + str(p['id']) + ','
+                    parStr = parStr[:len(parStr) - 1]
+                    parStr = parStr + '"'
+                    row2.append(parStr)
+
+                row2.append('None' if 'labels' not in i else repr(i['labels']['restricted']))
+                row2.append('None' if 'labels' not in i else repr(i['labels']['hidden']))
+                row2.append('None' if 'labels' not in i else repr(i['labels']['trashed']))
+                row2.append('None' if 'labels' not in i else repr(i['labels']['starred']))
+                row2.append('None' if 'labels' not in i else repr(i['labels']['viewed']))
+                row2.append('None' if 'markedViewedByMeDate' not in i else i['markedViewedByMeDate'])
+                row2.append('None' if 'lastViewedByMeDate' not in i else i['lastViewedByMeDate'])
+                row2.append('None' if 'lastModifyingUserName' not in i else '"' + i['lastModifyingUserName'] + '"')
+                row2.append('None' if 'writersCanShare' not in i else i['writersCanShare'])
+                row2.append('None' if 'sharedWithMeDate' not in i else i['sharedWithMeDate'])
+                row2.append('None' if 'sharingUser' not in i else '"' + i['sharingUser']['displayName'] + '"')
+                row2.append('None' if 'sharingUser' not in i else '"' + i['sharingUser']['emailAddress'] + '"')
+                if 'ownerNames' not in i or len(i['ownerNames']) == 0:
+                    row2.append('None')
+                else:
+                    ownStr = '"'
+                    for o in i['ownerNames']:
+                        ownStr = ownStr + str(o) + ','
+                    ownStr = ownStr[:len(ownStr) - 1]
+                    ownStr = ownStr + '"'
+                    row2.append(ownStr)
+
+                rowStr = ""
+                for r in row2:
+                    rowStr = rowStr + str(r) + ","
+                rowStr = rowStr[:len(rowStr) - 1]
+                f.write(rowStr + '\n')
+
+    def verify(self, reread=False):
+        # Compares the remote md5 with the one taken while the file was saved, reread is for --verify-only
         self.project.log("transaction", "Verifying all downloaded files...", "highlight", True)
         verification_file = os.path.join(self.project.working_dir, Common.timely_filename("verification", ".csv"))
-        errors = 0
-        pct = 0
-        tot_hashes = 0
-        with open(verification_file, 'w') as f:
-            f.write("TIME_PROCESSED,REMOTE_FILE,LOCAL_FILE,REMOTE_HASH,LOCAL_HASH,MATCH\n")
-            for item in self.verification:
-                rh = ""
-                match = ""
-                lh = Common.hashfile(open(item['local_file'], 'rb'), hashlib.md5())
-                lf = item['local_file']
-                rf = item['remote_file']
-                if 'remote_hash' in item:
-                    tot_hashes += 1
-                    rh = item['remote_hash']
-                    if lh == item['remote_hash']:
-                        match = "YES"
-                    else:
-                        match = "NO"
-                        errors += 1
-                        self.project.log("exception", "Verification failed for remote file {} and local file {}".format(rf,lf), "critical", True)
-                else:
-                    rh = "NONE PROVIDED"
-                    match = "N/A"
-                f.write('"{date}","{rf}","{lf}","{rh}","{lh}","{m}"\n'.format(date=Common.utc_get_datetime_as_string(),rf=rf,lf=lf,rh=rh,lh=lh,m=match))
-        pct = ((tot_hashes - errors) / tot_hashes) * 100
+        tot_hashes, errors = Verification.Verifier(self.project, reread=reread).verify(self.verification, verification_file)
+        pct = 100.0 if tot_hashes == 0 else ((tot_hashes - errors) / tot_hashes) * 100
         self.project.log("transaction", "Verification of {} items completed with {} errors. ({:.2f}% Success rate)".format(tot_hashes, errors, pct), "highlight", True)
 
+    def verify_existing(self):
+        self.verification = self.project.manifest.verification_items()
+        if self.verification:
+            self.project.log("transaction", "Found {} acquired files to verify in the manifest".format(len(self.verification)), "info", True)
+            self.verify(True)
+            return
+        # Projects acquired before there was a manifest, rebuild the list from the metadata saved next to every acquired file
+        trash_folder = os.path.join(self.project.acquisition_dir, "trash")
+        trash_metadata_folder = os.path.join(self.project.acquisition_dir, "trash_metadata")
+        folders = [(self.project.project_folders["metadata"], self.project.project_folders["data"]),
+                   (trash_metadata_folder, trash_folder)]
+        for metadata_folder, data_folder in folders:
+            for root, dirs, files in os.walk(metadata_folder):
+                for name in files:
+                    if not name.endswith(".json"):
+                        continue
+                    with open(os.path.join(root, name), 'r') as f:
+                        file = json.load(f)
+                    if file.get('mimeType') == "application/vnd.google-apps.folder":
+                        continue
+                    parentmap = os.path.relpath(root, metadata_folder)
+                    parentmap = "" if parentmap == os.curdir else parentmap
+                    v = {"remote_file": os.path.join(parentmap, file['title']),
+                         "local_file": os.path.join(data_folder, parentmap, name[:-len(".json")])}
+                    if 'md5Checksum' in file:
+                        v['remote_hash'] = file['md5Checksum']
+                    self.verification.append(v)
+        self.project.log("transaction", "Found {} acquired files to verify".format(len(self.verification)), "info", True)
+        self.verify(True)
+
     def sync(self):
         d1 = datetime.now()
         d = Downloader.Downloader
+        # Final file names depend on the whole tree, so when downloads overlap listing they land in
+        # the staging folder under their id and are moved into place once listing is done. Resumed
+        # projects list first so existing files can be checked before they are queued again.
+        incremental = self._can_acquire_incrementally()
+        streaming = self.project.args.mode == "full" and not self.project.args.prompt and not incremental and not self._has_acquired_data()
         if self.project.args.mode == "full":
             self.project.log("transaction", "Full acquisition initiated", "info", True)
-            d = Downloader.Downloader(self.project, self.oauth_provider.http_intercept, self._save_file, self.oauth_provider.get_auth_header,
-                                  self.project.threads)
+            if streaming:
+                d = Downloader.get_downloader(self.project, self.oauth_provider.http_intercept, self._save_staged_file, self.oauth_provider.get_auth_header,
+                                      self.project.threads, Downloader.STREAM_QUEUE_SIZE)
+            else:
+                d = Downloader.get_downloader(self.project, self.oauth_provider.http_intercept, self._save_file, self.oauth_provider.get_auth_header,
+                                      self.project.threads)
         else:
             self.project.log("transaction", "Metadata acquisition initiated", "info", True)
 
-        self.initialize_items()
-        cnt = len(self.files)
-        self.project.log("transaction", "Total items queued for acquisition: " + str(cnt), "info", True)
         self.metadata()
+        if incremental:
+            targets = self.initialize_changes()
+            self._add_metadata_rows(targets)
+        else:
+            # Taken before listing so nothing that changes while we list is missed next time
+            self.largest_change_id = self._get_largest_change_id()
+            if streaming:
+                d.start()
+                self.initialize_items(lambda files: self._stage_files(files, d))
+            else:
+                self.initialize_items(self._add_metadata_rows)
+            targets = self.files
+        cnt = len(targets)
+        self.project.log("transaction", "Total items queued for acquisition: " + str(cnt), "info", True)
 
         trash_folder = os.path.join(self.project.acquisition_dir, "trash")
         trash_metadata_folder = os.path.join(self.project.acquisition_dir, "trash_metadata")
 
-        for file in self.files:
+        for file in targets:
             self.project.log("transaction", "Calculating " + file['title'], "info", True)
             download_uri = self._get_download_url(file)
-            parentmap = self._get_parent_mapping(file, self.files)
+            parentmap = self._get_parent_mapping(file)
 
             filetitle = self._get_file_name(file)
             if filetitle != file['title']:
@@ -180,13 +222,19 @@ class GoogleDrive(OnlineStorage.OnlineStorage):
                     if 'md5Checksum' in file:
                         v['remote_hash'] = file['md5Checksum']
 
-                    if os.path.isfile(save_download_path):
-                        if 'md5Checksum' in file:
-                            file_hash = Common.hashfile(open(save_download_path, 'rb'), hashlib.md5())
-                            if file_hash == file['md5Checksum']:
+                    if not streaming and os.path.isfile(save_download_path):
+                        if self.project.manifest.is_current(save_download_path, file.get('md5Checksum'), file.get('version')):
+                            download_file = False
+                            Metrics.incr("files_skipped")
+                            self.project.log("exception", "Manifest matches local file for " + file['title'] + " ... Skipping download", "warning")
+                        elif 'md5Checksum' in file:
+                            digests = Common.hashfile_multi(save_download_path)
+                            if digests['md5'] == file['md5Checksum']:
                                 download_file = False
+                                self.project.record_digests(save_download_path, digests)
+                                Metrics.incr("files_skipped")
                                 self.project.log("exception", "Local and remote hash matches for " + file[
-                                    'title'] + " ... Skipping download", "warning", True)
+                                    'title'] + " ... Skipping download", "warning")
                             else:
                                 self.project.log("exception", "Local and remote hash differs for " + file[
                                     'title'] + " ... Queuing for download", "critical", True)
@@ -195,9 +243,18 @@ class GoogleDrive(OnlineStorage.OnlineStorage):
                         else:
                             self.project.log("exception", "No hash information for file ' " + file['title'] + "'", "warning", True)
 
-                    if download_file and download_uri:
+                    if download_uri:
+                        self.project.manifest.track(save_download_path, file['id'], v['remote_file'], file.get('fileSize'), file.get('md5Checksum'),
+                                                    file.get('version'), Manifest.QUEUED if download_file else Manifest.DOWNLOADED)
+                    if streaming:
+                        if download_uri:
+                            self._place_staged_file(file['id'], save_download_path)
+                    elif download_file and download_uri:
+                        # Picks up downloads an interrupted streaming run left in the staging folder
+                        self.project.move_partial(os.path.join(self.staging_dir, Common.safe_file_name(file['id'])), save_download_path)
                         self.project.log("transaction", "Queueing " + file['title'] + " for download...", "info", True)
-                        d.put(Downloader.DownloadSlip(download_uri, file, save_download_path, 'title'))
+                        d.put(Downloader.DownloadSlip(download_uri, file, save_download_path, 'title', file.get('fileSize'), file.get('md5Checksum'),
+                                                      modified=Common.parse_timestamp(file.get('modifiedDate'))))
                         if 'fileSize' in file:
                             self.file_size_bytes += int(file['fileSize'])
 
@@ -214,44 +271,186 @@ class GoogleDrive(OnlineStorage.OnlineStorage):
         if self.project.args.prompt:
             IO.get("Press ENTER to begin acquisition...")
 
-        d.start()
-        d.wait_for_complete()
+        if self.project.args.mode == "full":
+            if not streaming:
+                d.start()
+            d.wait_for_complete()
+            if os.path.isdir(self.staging_dir):
+                self._clear_staging()
+            if not self.project.shutdown_signal and self.largest_change_id is not None:
+                self.project.save("DRIVE_CHANGE_ID", self.largest_change_id)
         d2 = datetime.now()
         delt = d2 - d1
         self.verify()
         self.project.log("transaction", "Acquisition completed in {}".format(str(delt)), "highlight", True)
 
-    def _get_parent_mapping(self, i, items):
-        # This is the secret sauce
-        folderpath = ""
-        while 'parents' in i or len(i['parents']) != 0:
-            for p in i['parents']:
-                if p['isRoot'] == True:
-                    return folderpath
-                else:
-                    item = self._get_item_by_id(p['id'], items)
-                    if item is not None:
-                        folderpath = os.path.join(self._get_parent_mapping(item, items), item['title'])
-                        return folderpath
+    def _can_acquire_incrementally(self):
+        if not getattr(self.project.args, 'incremental', False):
+            return False
+        if 'DRIVE_CHANGE_ID' in self.project.config and Paginator.Paginator(self.project, "google_drive_files", None).completed_items() is not None:
+            return True
+        self.project.log("exception", "No previous Google Drive acquisition to continue from, running a full acquisition", "warning", True)
+        return False
+
+    def _get_largest_change_id(self):
+        response = Common.webrequest(Common.joinurl(self.project.config['API_ENDPOINT'], "about"), self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept)
+        return int(json.loads(response)['largestChangeId'])
+
+    def initialize_changes(self):
+        # Rebuild the tree from the last completed listing and apply every change since then.
+        # Returns the items that were added or modified.
+        listing = Paginator.Paginator(self.project, "google_drive_files", self._get_page)
+        self.files = []
+        self.items_by_id = {}
+        self.folder_paths = {}
+        self._add_items_to_files(listing.completed_items())
+
+        start_change_id = int(self.project.config['DRIVE_CHANGE_ID']) + 1
+        self.largest_change_id = start_change_id - 1
+        self.project.log("transaction", "Fetching Google Drive changes since change {}".format(start_change_id), "info", True)
+        link = Common.joinurl(self.project.config['API_ENDPOINT'],
+                              "changes?includeDeleted=true&includeSubscribed=true&maxResults=1000&startChangeId={}".format(start_change_id))
+
+        self.change_log = os.path.join(self.project.working_dir, Common.timely_filename("changes", ".csv"))
+        changed = {}
+        with open(self.change_log, 'w') as log:
+            log.write("TIME_PROCESSED,CHANGE_ID,FILE_ID,TITLE,ACTION\n")
+            changes = Paginator.Paginator(self.project, "google_drive_changes", self._get_changes_page, link)
+            for page in changes.pages():
+                for change in page:
+                    f_id = change['fileId']
+                    if change.get('deleted') or 'file' not in change:
+                        item = self.items_by_id.pop(f_id, None)
+                        changed.pop(f_id, None)
+                        action = "removed"
+                        title = item['title'] if item else ""
                     else:
-                        return folderpath
-            return folderpath
+                        action = "modified" if f_id in self.items_by_id else "added"
+                        item = change['file']
+                        self.items_by_id[f_id] = item
+                        changed[f_id] = item
+                        title = item['title']
+                    log.write('"{date}","{cid}","{fid}","{title}","{action}"\n'.format(date=Common.utc_get_datetime_as_string(), cid=change.get('id', ''),
+                                                                                   fid=f_id, title=title, action=action))
+                    self.project.log("transaction", "Change {}: {} {}".format(change.get('id', ''), action, title), "info", True)
+
+        self.files = list(self.items_by_id.values())
+        self.folder_paths = {}
+        self.title_index = None
+        listing.replace_items(self.files)
+        self.project.log("transaction", "{} items changed since the last acquisition".format(len(changed)), "highlight", True)
+        return list(changed.values())
+
+    def _get_changes_page(self, link):
+        response = Common.webrequest(link, self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept)
+        json_response = json.loads(response)
+        if 'largestChangeId' in json_response:
+            self.largest_change_id = max(self.largest_change_id, int(json_response['largestChangeId']))
+        return json_response.get('items', []), json_response.get('nextLink')
+
+    def _has_acquired_data(self):
+        for folder in (self.project.project_folders["data"], os.path.join(self.project.acquisition_dir, "trash")):
+            if os.path.isdir(folder) and os.listdir(folder):
+                return True
+        return False
+
+    def _stage_files(self, files, d):
+        self._add_metadata_rows(files)
+        for file in files:
+            download_uri = self._get_download_url(file)
+            if download_uri:
+                staged_path = os.path.join(self.staging_dir, Common.safe_file_name(file['id']))
+                self.project.log("transaction", "Queueing " + file['title'] + " for download...", "info", True)
+                d.put(Downloader.DownloadSlip(download_uri, file, staged_path, 'title', file.get('fileSize'), file.get('md5Checksum'),
+                                              modified=Common.parse_timestamp(file.get('modifiedDate'))))
+                if 'fileSize' in file:
+                    self.file_size_bytes += int(file['fileSize'])
+
+    def _save_staged_file(self, data, slip):
+        digests = self._save_file(data, slip)
+        with self.staging_lock:
+            self.staged[slip.item['id']] = slip.savepath
+            final_path = self.placements.get(slip.item['id'])
+        if final_path:
+            self._move_staged_file(slip.savepath, final_path)
+        return digests
+
+    def _place_staged_file(self, f_id, final_path):
+        with self.staging_lock:
+            self.placements[f_id] = final_path
+            staged_path = self.staged.get(f_id)
+        if staged_path:
+            self._move_staged_file(staged_path, final_path)
+
+    def _move_staged_file(self, staged_path, final_path):
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        self.project.move_data(staged_path, final_path)
+        self.project.log("transaction", "Moved {} to {}".format(staged_path, final_path), "info", True)
+
+    def _clear_staging(self):
+        try:
+            os.rmdir(self.staging_dir)
+        except OSError:
+            self.project.log("exception", "Some staged downloads could not be placed, they were left in " + self.staging_dir, "warning", True)
+
+    def _get_parent_mapping(self, i):
+        # This is the secret sauce
+        if 'parents' not in i or len(i['parents']) == 0:
+            return ""
+        p = i['parents'][0]
+        if p['isRoot'] == True:
+            return ""
+        folderpath = self._get_folder_path(p['id'])
+        if folderpath is None:
+            return ""
         return folderpath
 
-    def _get_item_by_id(self, f_id, items):
-        for i in items:
-            if i['id'] == f_id:
-                return i
-        return None
+    def _get_folder_path(self, f_id):
+        # Path of a folder including its own title. Walks up until it meets a folder that was
+        # already resolved, so the whole tree is resolved in linear time.
+        chain = []
+        seen = set()
+        base = ""
+        while f_id not in self.folder_paths:
+            item = self._get_item_by_id(f_id)
+            if item is None:
+                if not chain:
+                    return None
+                break
+            chain.append(item)
+            seen.add(f_id)
+            if 'parents' not in item or len(item['parents']) == 0 or item['parents'][0]['isRoot'] == True:
+                break
+            f_id = item['parents'][0]['id']
+            if f_id in seen:
+                break
+        else:
+            base = self.folder_paths[f_id]
+
+        for item in reversed(chain):
+            base = os.path.join(base, item['title'])
+            self.folder_paths[item['id']] = base
+        return base
+
+    def _get_item_by_id(self, f_id):
+        return self.items_by_id.get(f_id)
 
     def is_duplicate(self, file):
-        for item in self.files:
-            if item['title'] == file['title']:
-                if file['version'] != item['version']:
-                    if self._get_parent_mapping(file, self.files) == self._get_parent_mapping(item, self.files):
-                        return True
+        if self.title_index is None:
+            self._build_title_index()
+        versions = self.title_index.get((self._get_parent_mapping(file), file['title']), ())
+        for version in versions:
+            if version != file['version']:
+                return True
         return False
 
+    def _build_title_index(self):
+        # (parent path, title) -> versions seen, answers is_duplicate without walking every file
+        self.title_index = {}
+        for item in self.files:
+            key = (self._get_parent_mapping(item), item['title'])
+            self.title_index.setdefault(key, set()).add(item['version'])
+
     def _get_file_name(self, file):
         mime_type = file['mimeType']
         title = file['title']
@@ -334,19 +533,21 @@ class GoogleDrive(OnlineStorage.OnlineStorage):
     # def get_auth_header(self):
     #     return {'Authorization': 'Bearer ' + self.oauth['access_token']}
 
-    def _build_fs(self, link):
+    def _build_fs(self, link, on_items=None):
+        paginator = Paginator.Paginator(self.project, "google_drive_files", self._get_page, link)
+        for items in paginator.pages():
+            self._add_items_to_files(items, on_items)
+
+    def _get_page(self, link):
         self.project.log("transaction", "Calculating total drive items...", "info", True)
         response = Common.webrequest(link, self.oauth_provider.get_auth_header(), self.oauth_provider.http_intercept)
         json_response = json.loads(response)
+        return json_response['items'], json_response.get('nextLink')
 
-        if 'nextLink' in json_response:
-            items = json_response['items']
-            self._add_items_to_files(items)
-            self._build_fs(json_response['nextLink'])
-        else:
-            items = json_response['items']
-            self._add_items_to_files(items)
-
-    def _add_items_to_files(self, items):
+    def _add_items_to_files(self, items, on_items=None):
         for i in items:
             self.files.append(i)
+            self.items_by_id[i['id']] = i
+        self.title_index = None
+        if on_items:
+            on_items(items)
@@ -0,0 +1,146 @@
+__author__ = 'aurcioli'
+import os
+import sqlite3
+import threading
+
+QUEUED = "queued"
+PARTIAL = "partial"
+DOWNLOADED = "downloaded"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    local_path TEXT PRIMARY KEY,
+    remote_id TEXT,
+    remote_path TEXT,
+    size INTEGER,
+    remote_hash TEXT,
+    remote_version TEXT,
+    local_hash TEXT,
+    local_sha1 TEXT,
+    local_sha256 TEXT,
+    local_size INTEGER,
+    local_mtime INTEGER,
+    state TEXT,
+    validator TEXT
+);
+CREATE INDEX IF NOT EXISTS items_remote_id ON items (remote_id);
+"""
+
+# Columns added after the first version of the table, created on older manifests when opened
+COLUMNS = {"validator": "TEXT"}
+
+
+class Manifest:
+    # Everything we know about every file of an acquisition, kept in a SQLite database inside the
+    # project. Rows are keyed by local path. Local size and mtime are stored together with the
+    # digests so a resumed project can trust them without reading the file again.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+            existing = [row['name'] for row in self.db.execute("PRAGMA table_info(items)")]
+            for column, kind in COLUMNS.items():
+                if column not in existing:
+                    self.db.execute("ALTER TABLE items ADD COLUMN {} {}".format(column, kind))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def track(self, local_path, remote_id, remote_path=None, size=None, remote_hash=None, remote_version=None, state=QUEUED):
+        # Queueing a partial download again keeps it partial, If-Range decides if it can be resumed
+        with self.lock:
+            self.db.execute("INSERT INTO items (local_path, remote_id, remote_path, size, remote_hash, remote_version, state) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (local_path) DO UPDATE SET "
+                            "remote_id = excluded.remote_id, remote_path = excluded.remote_path, size = excluded.size, "
+                            "remote_hash = excluded.remote_hash, remote_version = excluded.remote_version, "
+                            "state = CASE WHEN items.state = '{}' AND excluded.state = '{}' THEN items.state ELSE excluded.state END".format(PARTIAL, QUEUED),
+                            (local_path, remote_id, remote_path, size, remote_hash, remote_version, state))
+            self.db.commit()
+
+    def stored(self, local_path, digests):
+        # Called once a file has been written completely
+        st = os.stat(local_path)
+        with self.lock:
+            self.db.execute("INSERT INTO items (local_path, local_hash, local_sha1, local_sha256, local_size, local_mtime, state) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (local_path) DO UPDATE SET "
+                            "local_hash = excluded.local_hash, local_sha1 = excluded.local_sha1, local_sha256 = excluded.local_sha256, "
+                            "local_size = excluded.local_size, local_mtime = excluded.local_mtime, state = excluded.state",
+                            (local_path, digests.get('md5'), digests.get('sha1'), digests.get('sha256'), st.st_size, st.st_mtime_ns, DOWNLOADED))
+            self.db.commit()
+
+    def partial(self, local_path, validator):
+        # The download of local_path broke off, what was received is kept next to it to resume from.
+        # validator is the ETag or Last-Modified of the response, without it we can't resume safely.
+        with self.lock:
+            self.db.execute("INSERT INTO items (local_path, state, validator) VALUES (?, ?, ?) ON CONFLICT (local_path) DO UPDATE SET "
+                            "state = excluded.state, validator = excluded.validator", (local_path, PARTIAL, validator))
+            self.db.commit()
+
+    def remove(self, local_path):
+        with self.lock:
+            self.db.execute("DELETE FROM items WHERE local_path = ?", (local_path,))
+            self.db.commit()
+
+    def get(self, local_path):
+        with self.lock:
+            return self.db.execute("SELECT * FROM items WHERE local_path = ?", (local_path,)).fetchone()
+
+    def local_paths(self, remote_id):
+        with self.lock:
+            return [row['local_path'] for row in self.db.execute("SELECT local_path FROM items WHERE remote_id = ?", (remote_id,))]
+
+    def remote_ids(self):
+        with self.lock:
+            return [row['remote_id'] for row in self.db.execute("SELECT DISTINCT remote_id FROM items WHERE remote_id IS NOT NULL")]
+
+    def digests(self, local_path, unchanged=True):
+        # Digests recorded for the file, None if it changed on disk since they were taken. With
+        # unchanged=False they are returned anyway, to compare the file against.
+        row = self._unchanged(local_path) if unchanged else self.get(local_path)
+        if row is None or row['local_hash'] is None:
+            return None
+        return {'md5': row['local_hash'], 'sha1': row['local_sha1'], 'sha256': row['local_sha256']}
+
+    def is_current(self, local_path, remote_hash=None, remote_version=None):
+        # True if local_path holds a complete, untouched copy of the remote item. Content hashes are
+        # compared when the remote side has one, otherwise the remote version has to be the same.
+        row = self._unchanged(local_path)
+        if row is None:
+            return False
+        if remote_hash is not None:
+            return row['local_hash'] == remote_hash
+        if remote_version is not None:
+            return row['remote_version'] == remote_version
+        return True
+
+    def verification_items(self):
+        with self.lock:
+            rows = self.db.execute("SELECT remote_path, local_path, remote_hash FROM items WHERE remote_path IS NOT NULL "
+                                   "ORDER BY local_path").fetchall()
+        items = []
+        for row in rows:
+            v = {"remote_file": row['remote_path'], "local_file": row['local_path']}
+            if row['remote_hash'] is not None:
+                v['remote_hash'] = row['remote_hash']
+            items.append(v)
+        return items
+
+    def _unchanged(self, local_path):
+        row = self.get(local_path)
+        if row is None or row['state'] != DOWNLOADED or row['local_size'] is None:
+            return None
+        try:
+            st = os.stat(local_path)
+        except OSError:
+            return None
+        if st.st_size != row['local_size'] or st.st_mtime_ns != row['local_mtime']:
+            return None
+        return row
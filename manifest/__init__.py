@@ -0,0 +1 @@
+__author__ = 'aurcioli'
\ No newline at end of file
@@ -0,0 +1,157 @@
+__author__ = 'aurcioli'
+import http.server
+import json
+import os
+import threading
+import time
+
+from common import Common
+from metrics import Metrics
+
+# Seconds over which rates are measured
+RATE_WINDOW = 5.0
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PREFIX = "searchgiant_"
+
+
+class Exporter:
+    # Live figures of a running acquisition: the Metrics counters, rates, queue depth of every
+    # stage, active workers and an ETA. Served as OpenMetrics on a local port and appended as JSON
+    # snapshots to logs/metrics.jsonl so runs can be compared afterwards.
+
+    def __init__(self, project, port=None, interval=60):
+        self.project = project
+        self.port = port
+        self.interval = interval
+        self.snapshot_file = os.path.join(project.project_folders["logs"], "metrics.jsonl")
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.sample = (time.monotonic(), {})
+        self.rates = {"bytes_per_second": 0.0, "requests_per_second": 0.0, "completed_per_second": 0.0}
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.port:
+            exporter = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = exporter.openmetrics().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", OPENMETRICS_TYPE)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+            self.server.daemon_threads = True
+            t = threading.Thread(target=self.server.serve_forever)
+            t.daemon = True
+            t.name = "Metrics endpoint"
+            t.start()
+            self.project.log("transaction", "Serving metrics on http://127.0.0.1:{}/metrics".format(self.port), "highlight", True)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.name = "Metrics sampler"
+        self.thread.start()
+
+    def stop(self):
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.interval:
+            self._write_snapshot()
+
+    def snapshot(self):
+        counters = Metrics.snapshot()
+        with self.lock:
+            rates = dict(self.rates)
+        stages = {}
+        for stage in self.project.stages:
+            name = stage.name
+            if name in stages:
+                name = "{}_{}".format(name, len(stages))
+            stages[name] = stage.depth()
+        pending = sum(stages.values())
+        eta = pending / rates["completed_per_second"] if pending and rates["completed_per_second"] else None
+        elapsed = time.time() - self.started
+        return {
+            "time": Common.utc_get_datetime_as_string(),
+            "elapsed_seconds": round(elapsed, 3),
+            "counters": counters,
+            "rates": rates,
+            # Over the whole run so far, what runs are best compared by
+            "averages": {"bytes_per_second": round(counters.get("bytes_written", 0) / elapsed, 3),
+                         "requests_per_second": round(counters.get("http_requests", 0) / elapsed, 3)},
+            "queue_depth": stages,
+            "active_workers": self.project.scheduler.budget.active + sum(stage.active() for stage in self.project.stages),
+            "worker_limit": self.project.scheduler.budget.limit,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+        }
+
+    def openmetrics(self):
+        snap = self.snapshot()
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append("# TYPE {}{} {}".format(PREFIX, name, kind))
+            suffix = "_total" if kind == "counter" else ""
+            for labels, value in samples:
+                label_text = "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels.items()) + "}" if labels else ""
+                lines.append("{}{}{}{} {}".format(PREFIX, name, suffix, label_text, value))
+
+        errors = []
+        for name, value in sorted(snap["counters"].items()):
+            if name.startswith("http_errors_"):
+                errors.append(({"code": name[len("http_errors_"):]}, value))
+            else:
+                metric(name, "counter", [({}, value)])
+        if errors:
+            metric("http_errors", "counter", errors)
+        for name, value in sorted(snap["rates"].items()):
+            metric(name, "gauge", [({}, value)])
+        metric("queue_depth", "gauge", [({"stage": name}, depth) for name, depth in sorted(snap["queue_depth"].items())])
+        metric("active_workers", "gauge", [({}, snap["active_workers"])])
+        metric("worker_limit", "gauge", [({}, snap["worker_limit"])])
+        if snap["eta_seconds"] is not None:
+            metric("eta_seconds", "gauge", [({}, snap["eta_seconds"])])
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def _run(self):
+        last_snapshot = time.monotonic()
+        while not self.stopping.wait(RATE_WINDOW):
+            self._sample()
+            if self.interval and time.monotonic() - last_snapshot >= self.interval:
+                last_snapshot = time.monotonic()
+                self._write_snapshot()
+
+    def _sample(self):
+        now = time.monotonic()
+        counters = Metrics.snapshot()
+        then, previous = self.sample
+        elapsed = now - then
+        if elapsed <= 0:
+            return
+        with self.lock:
+            for rate, counter in (("bytes_per_second", "bytes_written"), ("requests_per_second", "http_requests"),
+                                  ("completed_per_second", "slips_completed")):
+                self.rates[rate] = round((counters.get(counter, 0) - previous.get(counter, 0)) / elapsed, 3)
+            self.sample = (now, counters)
+
+    def _write_snapshot(self):
+        with open(self.snapshot_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.snapshot(), sort_keys=True) + "\n")
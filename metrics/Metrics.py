@@ -0,0 +1,23 @@
+__author__ = 'aurcioli'
+import threading
+
+# Process wide counters. Anything that wants to report progress or savings just
+# bumps a named counter here.
+
+_lock = threading.Lock()
+_counters = {}
+
+
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
@@ -1,10 +1,17 @@
 __author__ = 'aurcioli'
 import json
+import threading
+import time
 import urllib.parse
 from common import Common
 from oi.IO import IO
 
 
+# Tokens are renewed this many seconds (at most a quarter of their lifetime) before they expire, so
+# requests in flight don't get a 401
+REFRESH_MARGIN = 120
+
+
 class OAuth2Provider:
     default = {
         "google": {
@@ -41,6 +48,9 @@ class OAuth2Provider:
         if 'OAUTH' in self.project.config:
             self.oauth = self.project.config['OAUTH']
         self.key_to_the_kingdom = key_to_the_kingdom
+        # Only one thread renews the token, the others wait for it and use the new one. Reentrant
+        # because the token request itself goes through http_intercept.
+        self.lock = threading.RLock()
 
     def authorize(self):
         self.project.log("transaction", "Initiating OAUTH2 Protocol with " + self.config['TOKEN_ENDPOINT'], "info",
@@ -122,19 +132,40 @@ class OAuth2Provider:
         self.project.save("OAUTH", self.oauth)
 
     def parse_token(self, response):
+        # Refreshed tokens come without the refresh token, it stays the same
+        if 'refresh_token' not in response and self.oauth.get('refresh_token'):
+            response['refresh_token'] = self.oauth['refresh_token']
+        if response.get('expires_in'):
+            lifetime = int(response['expires_in'])
+            response['refresh_at'] = time.time() + lifetime - min(REFRESH_MARGIN, lifetime / 4)
         self.oauth = response
 
+    def renew(self, stale_token=None):
+        # Authorizes again unless another thread already replaced stale_token while we waited
+        with self.lock:
+            if stale_token is not None and stale_token != self.oauth.get('access_token'):
+                return
+            self.authorize()
+
     def http_intercept(self, err):
-        if self.provider == "google":
-            if err.code == 401:
-                self.authorize()
-                return self.get_auth_header()
-        elif self.provider == "dropbox":
-            if err.code == 401 or err.code == 400:
-                self.authorize()
-                return self.get_auth_header()
+        rejected = err.code == 401
+        if self.provider == "dropbox":
+            rejected = rejected or err.code == 400
+        if rejected:
+            self.renew(self._token_of(err))
+            return self.get_auth_header()
 
     def get_auth_header(self):
+        refresh_at = self.oauth.get('refresh_at')
+        if refresh_at and self.oauth.get('refresh_token') and time.time() > refresh_at:
+            self.renew(self.oauth.get('access_token'))
         return {'Authorization': 'Bearer ' + self.oauth['access_token']}
 
+    def _token_of(self, err):
+        # The token the rejected request was sent with, if the caller attached its headers
+        header = getattr(err, 'request_headers', {}).get('Authorization', '')
+        if header.startswith('Bearer '):
+            return header[len('Bearer '):]
+        return None
+
 
@@ -0,0 +1,97 @@
+__author__ = 'aurcioli'
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+
+# Most records written between two flushes of the log files
+BATCH_SIZE = 1000
+
+
+def compress_rotated(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+class BatchedFileHandler(logging.handlers.RotatingFileHandler):
+    # Log file that is only flushed by the LogWriter once per batch. With a max_bytes it is rotated
+    # and the old files are gzipped, only the newest backups of them are kept.
+
+    def __init__(self, filename, max_bytes=0, backups=0, encoding=None):
+        super(BatchedFileHandler, self).__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding=encoding)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = compress_rotated
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super(BatchedFileHandler, self).flush()
+
+
+class LogWriter:
+    # Loggers only put their records in a queue, one background thread writes them to the handler
+    # of the logger they came from and flushes once per batch instead of after every record.
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.handlers = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def attach(self, logger, handler):
+        self.handlers[logger.name] = handler
+        logger.addHandler(logging.handlers.QueueHandler(self.queue))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.name = "Log writer"
+        self.thread.start()
+        # Daemon threads are dropped at exit, whatever is still queued gets written first
+        atexit.register(self.stop)
+
+    def stop(self):
+        # Only once nothing logs anymore, records put after this are not written
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers.values():
+            handler.close()
+
+    def is_writer(self, thread):
+        return thread is self.thread
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    stopping = True
+                else:
+                    self.handlers[record.name].handle(record)
+            # Records that came in after the marker are still written
+            while stopping:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is not None:
+                    self.handlers[record.name].handle(record)
+            # Loggers may be attached while this runs
+            for handler in list(self.handlers.values()):
+                handler.flush_batch()
@@ -0,0 +1,72 @@
+__author__ = 'aurcioli'
+import shutil
+import sys
+import threading
+import time
+
+from common import Common
+from metrics import Metrics
+from oi.IO import IO, colors
+
+# Seconds between redraws of the progress line, and between progress lines when stdout isn't a terminal
+TTY_INTERVAL = 0.2
+PIPE_INTERVAL = 5.0
+
+
+class Progress:
+    # A single status line with the totals so far and the latest thing that happened, redrawn a few
+    # times per second at most. Routine messages only update it, everything else is printed above it.
+
+    def __init__(self):
+        self.tty = sys.stdout.isatty()
+        self.interval = TTY_INTERVAL if self.tty else PIPE_INTERVAL
+        self.lock = threading.Lock()
+        self.last = 0.0
+        self.message = ""
+        self.shown = False
+
+    def update(self, message):
+        self.message = message
+        if time.monotonic() - self.last < self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+            self._draw()
+
+    def put(self, message, level):
+        with self.lock:
+            self._clear()
+            IO.put(message, level)
+
+    def finish(self):
+        # Leaves the final totals on screen if there was any progress to show
+        with self.lock:
+            if self.last:
+                self._draw()
+                if self.tty:
+                    print()
+                self.shown = False
+
+    def _line(self):
+        # Files already acquired by an earlier run are only counted here, each one is in the logs
+        skipped = Metrics.get("files_skipped")
+        return "{} files saved ({}){} | {}".format(Metrics.get("files_saved"), Common.sizeof_fmt(Metrics.get("bytes_saved")),
+                                                 ", {} skipped".format(skipped) if skipped else "", self.message)
+
+    def _draw(self):
+        line = self._line()
+        if self.tty:
+            width = shutil.get_terminal_size().columns - 5
+            sys.stdout.write("\r\033[K[{}>>{}] {}".format(IO.fall_back_lb, colors.reset, line[:width]))
+            sys.stdout.flush()
+        else:
+            IO.put(line)
+        self.shown = True
+
+    def _clear(self):
+        if self.tty and self.shown:
+            sys.stdout.write("\r\033[K")
+            self.shown = False
@@ -17,5 +17,9 @@ class OnlineStorage:
         if not os.path.isdir(path_to_create):
             os.makedirs(path_to_create, exist_ok=True)
 
-        self.project.savedata(data, savepath, stream)
+        digests = self.project.savedata(data, savepath, stream, slip.offset, slip.validator)
         self.project.log("transaction", "Saved file to " + savepath, "info", True)
+        return digests
+
+    def verify_existing(self):
+        self.project.log("exception", "Verification of an existing acquisition is not supported for " + self.name, "warning", True)
@@ -17,26 +17,36 @@
 __author__ = 'alexander'
 import os
 import logging
-from logging import FileHandler
 import time
-import shutil
+import io
+import threading
 import http.client
+import shutil
 
-from config import ConfigLoader
+from config import StateStore
+from downloader import RateControl
+from downloader import Scheduler
+from common import Common
+from manifest import Manifest
+from metrics import Metrics
+from metrics import Exporter
 from oi.IO import IO
+from oi import LogWriter
+from oi import Progress
 from onlinestorage import OnlineStorage
 from googledrive import GoogleDrive
 from dropbox import Dropbox
 from gmail import GMail
 
 
+# Suffix of files that are still being received
+PARTIAL_SUFFIX = ".part"
+
+
 class DefaultConfigs:
-    defaults = ("CLIENT_ID = ''\r\nCLIENT_SECRET = ''\r\n")
+    defaults = {"CLIENT_ID": "", "CLIENT_SECRET": ""}
 
 class Project:
-    shutdown_signal = 0
-    pause_signal = 0
-
     working_dir = ""
     transaction_log = ""
     exception_log = ""
@@ -50,6 +60,9 @@ class Project:
     args = ""
 
     project_folders = {}
+    manifest = None
+    scheduler = None
+    exporter = None
 
     def __init__(self, args):
         # Meh...
@@ -62,6 +75,18 @@ class Project:
         self.name = project_name
         self.threads = threads
         self.working_dir = os.path.join(working_dir, self.name)
+        Common.configure_connection_pool(args.pool_size)
+        # Cleared while the acquisition is paused, set once it has to stop
+        self.running = threading.Event()
+        self.running.set()
+        self.stopping = threading.Event()
+        self.stages = []
+        self.rate_limiter = RateControl.TokenBucket(getattr(args, 'rate_limit', None))
+        # Workers shared by every threaded downloader of the project
+        large_file = getattr(args, 'segment_threshold', 0) * 1024 * 1024
+        self.scheduler = Scheduler.Scheduler(self, threads, RateControl.max_concurrency(self, threads),
+                                             getattr(args, 'order', "fifo"),
+                                             Scheduler.parse_host_limits(getattr(args, 'host_limit', None)), large_file)
         self.acquisition_dir = os.path.join(self.working_dir, "acquisition")
 
         if os.path.exists(self.working_dir):
@@ -73,10 +98,13 @@ class Project:
         self.project_folders["data"] = os.path.join(self.acquisition_dir, "data")
         self.project_folders["logs"] = os.path.join(self.working_dir, "logs")
         self.project_folders["metadata"] = os.path.join(self.acquisition_dir, "metadata")
+        self.project_folders["listing"] = os.path.join(self.working_dir, "listing")
         #self.project_folders["trash"] = os.path.join(self.acquisition_dir, "trash")
         #self.project_folders["trash_metadata"] = os.path.join(self.acquisition_dir, "trash_metadata")
 
-        self.config_file = os.path.join(self.working_dir, "config.cfg")
+        self.config_file = os.path.join(self.working_dir, "config.json")
+        # Where projects created by older versions keep their settings
+        self.legacy_config_file = os.path.join(self.working_dir, "config.cfg")
 
         for f in self.project_folders:
             IO.put("{} path is {}".format(f, self.project_folders[f]))
@@ -87,15 +115,18 @@ class Project:
         IO.put("Config file is " + self.config_file)
 
         if not os.path.isfile(self.config_file):
-            IO.put("Config file not found, creating default config file", "warn")
-            with open(self.config_file, 'w') as f:
-                f.write(DefaultConfigs.defaults)
+            if os.path.isfile(self.legacy_config_file):
+                IO.put("Converting " + self.legacy_config_file, "warning")
+            else:
+                IO.put("Config file not found, creating default config file", "warn")
 
-        self.config = ConfigLoader.ConfigLoader()
-        self.config.from_file(self.config_file)
+        self.config = StateStore.StateStore(self.config_file, self.legacy_config_file, DefaultConfigs.defaults)
 
         self.transaction_log = os.path.join(self.project_folders["logs"], "transaction.log")
         self.exception_log = os.path.join(self.project_folders["logs"], "exception.log")
+        self.digest_log = os.path.join(self.project_folders["logs"], "digests.csv")
+        self.digest_lock = threading.Lock()
+        self.manifest = Manifest.Manifest(os.path.join(self.working_dir, "manifest.db"))
 
         self.transaction_logger = logging.getLogger(project_name + "_t")
         self.exception_logger = logging.getLogger(project_name + "_e")
@@ -103,8 +134,11 @@ class Project:
         self.transaction_logger.setLevel(20)
         self.exception_logger.setLevel(20)
 
-        tfh = FileHandler(self.transaction_log)
-        efh = FileHandler(self.exception_log)
+        # Records are written by a background thread, rotated files are compressed
+        max_bytes = getattr(args, 'log_max_size', 0) * 1024 * 1024
+        backups = getattr(args, 'log_backups', 5)
+        tfh = LogWriter.BatchedFileHandler(self.transaction_log, max_bytes, backups)
+        efh = LogWriter.BatchedFileHandler(self.exception_log, max_bytes, backups)
 
         fmt = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
@@ -112,20 +146,76 @@ class Project:
         tfh.setFormatter(fmt)
         efh.setFormatter(fmt)
 
-        self.transaction_logger.addHandler(tfh)
-        self.exception_logger.addHandler(efh)
+        self.log_writer = LogWriter.LogWriter()
+        self.log_writer.attach(self.transaction_logger, tfh)
+        self.log_writer.attach(self.exception_logger, efh)
+        self.log_writer.start()
+        self.progress = Progress.Progress()
+
+    @property
+    def pause_signal(self):
+        return not self.running.is_set()
+
+    @property
+    def shutdown_signal(self):
+        return self.stopping.is_set()
+
+    def pause(self):
+        self.running.clear()
+        self._wake()
+
+    def resume(self):
+        self.running.set()
+        self._wake()
+
+    def shutdown(self):
+        self.stopping.set()
+        self.running.set()
+        self._wake()
+        # These threads only end when told to, anything waiting for every thread to end would hang.
+        # The log writer is stopped last, once nothing logs anymore (see stop_logging).
+        if self.exporter is not None:
+            self.exporter.stop()
+        for stage in self.stages:
+            stage.stop()
+
+    def stop_logging(self):
+        self.log_writer.stop()
+
+    def add_stage(self, stage):
+        self.stages.append(stage)
+
+    def _wake(self):
+        # Everything that waits for work or for a stage to complete looks at the signals again
+        self.scheduler.wake()
+        for stage in self.stages:
+            stage.wake()
 
     def start(self):
         instance = OnlineStorage.OnlineStorage
         if self.args.service == "google_drive":
             instance = GoogleDrive.GoogleDrive(self)
-            instance.sync()
         if self.args.service == "dropbox":
             instance = Dropbox.Dropbox(self)
-            instance.sync()
         if self.args.service == "gmail":
             instance = GMail.GMail(self)
-            instance.sync()
+        if self.args.verify_only:
+            instance.verify_existing()
+            return
+        self.exporter = Exporter.Exporter(self, getattr(self.args, 'metrics_port', None),
+                                          getattr(self.args, 'metrics_interval', 60))
+        self.exporter.start()
+        instance.sync()
+        self.scheduler.stop()
+        self.exporter.stop()
+        self.config.flush()
+        self.progress.finish()
+        self.log("transaction", "Opened {} connections, reused {} keep-alive connections".format(
+            Metrics.get("http_connections_opened"), Metrics.get("http_connections_reused")), "highlight", True)
+        if Metrics.get("files_skipped"):
+            self.log("transaction", "{} files were already acquired and skipped".format(Metrics.get("files_skipped")), "highlight", True)
+        if Metrics.get("http_throttled"):
+            self.log("transaction", "{} requests were rate limited and retried".format(Metrics.get("http_throttled")), "highlight", True)
 
 
     def log(self, type, message, level, stdout=False):
@@ -138,7 +228,11 @@ class Project:
         levels['highlight'] = 20
 
         if stdout:
-            IO.put(message, level)
+            # Routine messages only show up on the progress line unless asked for, they are all in the logs
+            if level == "info" and not getattr(self.args, 'verbose', False):
+                self.progress.update(message)
+            else:
+                self.progress.put(message, level)
 
         if type.lower() == "exception":
             self.exception_logger.log(levels[level], message)
@@ -146,26 +240,110 @@ class Project:
         self.transaction_logger.log(levels[level], message)
 
     def save(self, key, value):
-        self.config.from_file(self.config_file)
-        self.config[key] = value
-        with open(self.config_file,'w') as f:
-            for k,v in self.config.items():
-                if type(v) is str:
-                    f.write('{}="{}"\n'.format(k.upper(),v))
-                else:
-                    f.write('{}={}\n'.format(k.upper(),v))
-        self.config.from_file(self.config_file)
-
-    def savedata(self, data, filepath, stream=True):
-        try:
-            with open(filepath, 'wb') as f:
-                if stream:
-                    shutil.copyfileobj(data, f)
-                else:
-                    f.write(data.encode())
-
-        except http.client.IncompleteRead:
+        self.config.set(key.upper(), value)
 
-            self.log("exception", "WARNING - HTTP Incomplete Read from remote host to ({}) : Aborting!".format(filepath), "critical", True)
+    def savedata(self, data, filepath, stream=True, offset=0, validator=None):
+        if not stream:
+            data = data.encode()
+            with open(filepath, 'wb') as f:
+                digests = Common.copy_and_hash(io.BytesIO(data), f, written=self._count_written)
+            self.record_digests(filepath, digests)
+            Metrics.incr("files_saved")
+            Metrics.incr("bytes_saved", len(data))
+            return digests
+
+        # Streams are received into a .part file first. If the transfer breaks off it is kept and the
+        # next attempt (in this run or a later one) asks for the rest with a Range request, data
+        # then starts at offset.
+        part = self.partial_path(filepath)
+        hashers = Common.new_hashers()
+        try:
+            if offset:
+                Common.update_hashers(part, hashers, offset)
+                f = open(part, 'r+b')
+                f.truncate(offset)
+                f.seek(offset)
+            else:
+                f = open(part, 'wb')
+            with f:
+                digests = Common.copy_and_hash(data, f, hashers=hashers, written=self._count_written)
+        except (http.client.HTTPException, OSError):
+            received = os.path.getsize(part) if os.path.isfile(part) else 0
+            if validator and received:
+                self.manifest.partial(filepath, validator)
+                self.log("exception", "WARNING - Transfer of ({}) broke off after {} bytes, it will be resumed".format(filepath, received), "critical", True)
+            else:
+                self.log("exception", "WARNING - Transfer of ({}) broke off, it will be downloaded again".format(filepath), "critical", True)
             raise
-
+        os.replace(part, filepath)
+        self.record_digests(filepath, digests)
+        Metrics.incr("files_saved")
+        Metrics.incr("bytes_saved", os.path.getsize(filepath))
+        return digests
+
+    def _count_written(self, size):
+        # bytes_saved only grows once a file is complete, the transfer rate is taken from this
+        Metrics.incr("bytes_written", size)
+
+    def partial_path(self, filepath):
+        return filepath + PARTIAL_SUFFIX
+
+    def resume_point(self, filepath):
+        # (offset, validator) to continue an earlier partial download of filepath from, (0, None) if there is none
+        row = self.manifest.get(filepath)
+        part = filepath + PARTIAL_SUFFIX
+        if row is None or row['state'] != Manifest.PARTIAL or not row['validator'] or not os.path.isfile(part):
+            return 0, None
+        return os.path.getsize(part), row['validator']
+
+    def move_partial(self, src, dst):
+        # Lets a partial download of src be resumed as dst
+        offset, validator = self.resume_point(src)
+        if offset:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src + PARTIAL_SUFFIX, dst + PARTIAL_SUFFIX)
+            self.manifest.remove(src)
+            self.manifest.partial(dst, validator)
+
+    def discard_partial(self, filepath):
+        part = filepath + PARTIAL_SUFFIX
+        if os.path.isfile(part):
+            os.remove(part)
+
+    def record_digests(self, filepath, digests):
+        self.manifest.stored(filepath, digests)
+        with self.digest_lock:
+            new_log = not os.path.isfile(self.digest_log)
+            with open(self.digest_log, 'a') as f:
+                if new_log:
+                    f.write("TIME_PROCESSED,LOCAL_FILE,MD5,SHA1,SHA256\n")
+                f.write('"{}","{}","{}","{}","{}"\n'.format(Common.utc_get_datetime_as_string(), filepath, digests.get('md5', ''),
+                                                          digests.get('sha1', ''), digests.get('sha256', '')))
+
+    def savedata_linked(self, data, filepaths):
+        # Saves data once, under the first of filepaths. The others are hard links to that file, or
+        # copies of it where the file system has none.
+        for filepath in filepaths:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            # Writing to a link left by an earlier run would change every file linked to it
+            if os.path.lexists(filepath):
+                os.remove(filepath)
+        digests = self.savedata(data, filepaths[0], False)
+        for filepath in filepaths[1:]:
+            try:
+                os.link(filepaths[0], filepath)
+            except OSError:
+                shutil.copyfile(filepaths[0], filepath)
+            self.record_digests(filepath, digests)
+        return digests
+
+    def move_data(self, src, dst):
+        digests = self.manifest.digests(src)
+        os.replace(src, dst)
+        self.manifest.remove(src)
+        if digests:
+            self.record_digests(dst, digests)
+
+    def get_digests(self, filepath):
+        # What the file hashed to when it was acquired, even if it was touched since
+        return self.manifest.digests(filepath, False)
@@ -6,13 +6,15 @@ import traceback
 import os
 import argparse
 import threading
-import time
 import urllib.error
 import http.client
 
 from project import Project
 from oi import IO
 from common import Common
+from downloader import Scheduler
+from gmail import Batch
+from gmail import GMail
 
 if __name__ == '__main__':
     # original_sigint = signal.getsignal(signal.SIGINT)
@@ -27,9 +29,57 @@ if __name__ == '__main__':
                         required=False, default="full")
     parser.add_argument('--threads', '-t', metavar='threads', type=int,
                         help="Amount of parallel threads used to download files", default=5)
+    parser.add_argument('--engine', '-e', metavar='engine', type=str, choices=["threaded", "async"],
+                        help="Download engine. Accepted values are: threaded, async. Default value is: threaded",
+                        default="threaded")
+    parser.add_argument('--concurrency', '-c', metavar='requests', type=int,
+                        help="Amount of concurrent requests used by the async engine", default=100)
+    parser.add_argument('--max-concurrency', metavar='requests', type=int,
+                        help="Upper bound for adaptive concurrency. Default value is four times --threads (or --concurrency)",
+                        default=None)
+    parser.add_argument('--rate-limit', metavar='requests', type=float,
+                        help="Initial limit of requests per second. By default it is learned from the first rate limit error",
+                        default=None)
+    parser.add_argument('--segment-threshold', metavar='MiB', type=int,
+                        help="Files of at least this many MiB are downloaded in parallel byte ranges, 0 disables it. Default value is: 64",
+                        default=64)
+    parser.add_argument('--order', metavar='order', type=str, choices=Scheduler.ORDERS,
+                        help="Order in which files of the same size class are downloaded. Accepted values are: " +
+                        ", ".join(Scheduler.ORDERS) + ". Default value is: fifo", default="fifo")
+    parser.add_argument('--host-limit', metavar='host=requests', type=str, action='append',
+                        help="Maximum concurrent requests to one host, may be given more than once", default=None)
+    parser.add_argument('--batch-size', metavar='requests', type=int,
+                        help="GMail threads and messages fetched per batch request, at most {}. 1 disables batching. Default value is: {}".format(
+                            Batch.MAX_BATCH_SIZE, Batch.BATCH_SIZE), default=Batch.BATCH_SIZE)
+    parser.add_argument('--gmail-listing', metavar='listing', type=str, choices=GMail.LISTINGS,
+                        help="How GMail mail is listed. threads fetches every thread first, which also gives the total size up front. " +
+                        "messages lists message ids directly so downloads start at once. Default value is: threads", default="threads")
+    parser.add_argument('--pool-size', metavar='connections', type=int,
+                        help="Maximum idle keep-alive connections kept open per host", default=10)
+    parser.add_argument('--verbose', '-v', help="Print a line for every file instead of a progress line", action="store_true")
+    parser.add_argument('--log-max-size', metavar='MiB', type=int,
+                        help="Rotate log files once they reach this many MiB, rotated logs are compressed. 0 disables it. Default value is: 0",
+                        default=0)
+    parser.add_argument('--log-backups', metavar='files', type=int,
+                        help="Rotated log files kept per log. Default value is: 5", default=5)
+    parser.add_argument('--metrics-port', metavar='port', type=int,
+                        help="Serve live metrics in the OpenMetrics format on this local port", default=None)
+    parser.add_argument('--metrics-interval', metavar='seconds', type=int,
+                        help="Write a metrics snapshot to logs/metrics.jsonl this often, 0 disables it. Default value is: 60",
+                        default=60)
     parser.add_argument('--prompt', '-p', help="Prompt before actually downloading anything", action="store_true")
+    parser.add_argument('--incremental', '-i', help="Only acquire what changed since the last acquisition of this project",
+                        action="store_true")
+    parser.add_argument('--verify-only', help="Re-verify the files of an existing acquisition without downloading anything",
+                        action="store_true")
 
     args = parser.parse_args()
+    try:
+        Scheduler.parse_host_limits(args.host_limit)
+    except ValueError as err:
+        parser.error(str(err))
+    if not 1 <= args.batch_size <= Batch.MAX_BATCH_SIZE:
+        parser.error("--batch-size must be between 1 and {}".format(Batch.MAX_BATCH_SIZE))
 
     IO.IO.print_logo()
 
@@ -37,21 +87,23 @@ if __name__ == '__main__':
     try:
         P.start()
     except KeyboardInterrupt:
-        P.pause_signal = 1
+        P.pause()
         print(os.linesep)
         IO.IO.put("Ctrl+C or other interrupt caught.", "critical")
         shutdown = IO.IO.get("Are you sure you want to cancel? [Y/n]")
         result = Common.dialog_result(shutdown)
         if result:
-            P.pause_signal = 0
-            P.shutdown_signal = 1
-            while threading.active_count() > 1:
-                for t in threading.enumerate():
+            P.shutdown()
+            IO.IO.put("Waiting for all threads to shutdown gracefully...", "warning")
+            for t in threading.enumerate():
+                # Retries that are still waiting to be queued again are dropped
+                if t is not threading.current_thread() and not isinstance(t, threading.Timer) and not P.log_writer.is_writer(t):
                     IO.IO.put("Active: {}".format(t.name))
-                IO.IO.put("Waiting for all threads to shutdown gracefully...({} remaining)".format(threading.active_count()), "warning")
-                time.sleep(3)
+                    t.join()
+            # Whatever the threads logged while they stopped is written before we exit
+            P.stop_logging()
         else:
-            P.pause_signal = 0
+            P.resume()
 
     except urllib.error.HTTPError as err:
         P.log("exception", "HTTP ERROR {} - Response from server:\n{}".format(err.code, err.read().decode('utf-8')), "critical", True)
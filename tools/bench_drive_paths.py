@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+__author__ = 'aurcioli'
+# Times how GoogleDrive maps the items of a drive to folder paths and file names. A synthetic drive
+# of n items is resolved the way sync does it, _get_parent_mapping and _get_file_name for every item,
+# once with the code in googledrive/GoogleDrive.py and, for the smaller sizes, with the earlier code
+# that looked items up by scanning the whole list and resolved parents recursively. Both have to
+# give the same paths and names.
+#
+#   python3 tools/bench_drive_paths.py
+#   python3 tools/bench_drive_paths.py --sizes 1000 10000 100000 --reference-max 4000
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from googledrive import GoogleDrive
+
+
+def drive_items(n, seed=0):
+    # One folder in ten, each item in a random earlier folder or in the root. Titles repeat, so some
+    # files are versions of each other.
+    rnd = random.Random(seed)
+    folders = []
+    items = []
+    for i in range(n):
+        parent = rnd.choice(folders) if folders and rnd.random() < 0.95 else None
+        parents = [{'id': parent, 'isRoot': False}] if parent else [{'id': 'root', 'isRoot': True}]
+        if i % 10 == 0:
+            item = {'id': 'folder{}'.format(i), 'title': 'Folder {}'.format(i),
+                    'mimeType': 'application/vnd.google-apps.folder', 'version': '1', 'parents': parents}
+            folders.append(item['id'])
+        else:
+            item = {'id': 'file{}'.format(i), 'title': 'file{}.txt'.format(rnd.randrange(max(n // 4, 1))),
+                    'mimeType': 'text/plain', 'version': str(rnd.randrange(1, 3)), 'parents': parents}
+        items.append(item)
+    return items
+
+
+def new_drive(items):
+    # A GoogleDrive holding items, without a project behind it
+    drive = GoogleDrive.GoogleDrive.__new__(GoogleDrive.GoogleDrive)
+    drive.files = []
+    drive.items_by_id = {}
+    drive.folder_paths = {}
+    drive.title_index = None
+    drive._add_items_to_files(items)
+    return drive
+
+
+class ReferenceDrive(GoogleDrive.GoogleDrive):
+    # The earlier lookups: a scan of every item per parent and a recursion per folder level
+
+    def _get_parent_mapping(self, i):
+        folderpath = ""
+        while 'parents' in i or len(i['parents']) != 0:
+            for p in i['parents']:
+                if p['isRoot'] == True:
+                    return folderpath
+                else:
+                    item = self._get_item_by_id(p['id'])
+                    if item is not None:
+                        folderpath = os.path.join(self._get_parent_mapping(item), item['title'])
+                        return folderpath
+                    else:
+                        return folderpath
+            return folderpath
+        return folderpath
+
+    def _get_item_by_id(self, f_id):
+        for i in self.files:
+            if i['id'] == f_id:
+                return i
+        return None
+
+    def is_duplicate(self, file):
+        for item in self.files:
+            if item['title'] == file['title']:
+                if file['version'] != item['version']:
+                    if self._get_parent_mapping(file) == self._get_parent_mapping(item):
+                        return True
+        return False
+
+
+def resolve(drive):
+    # (seconds, [(parent path, file name)]) of every item
+    start = time.perf_counter()
+    names = [(drive._get_parent_mapping(file), drive._get_file_name(file)) for file in drive.files]
+    return time.perf_counter() - start, names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time folder path and file name resolution of Drive items")
+    parser.add_argument('--sizes', metavar='n', type=int, nargs='+', help="Drive sizes to time. Default value is: 1000 2000 4000 100000 500000",
+                        default=[1000, 2000, 4000, 100000, 500000])
+    parser.add_argument('--reference-max', metavar='n', type=int, help="Largest size the earlier code is timed at. Default value is: 4000", default=4000)
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    print("{:>10} {:>12} {:>12} {:>14}".format("items", "current (s)", "earlier (s)", "current us/item"))
+    for n in args.sizes:
+        items = drive_items(n)
+        current, names = resolve(new_drive(items))
+        earlier = ""
+        if n <= args.reference_max:
+            reference = ReferenceDrive.__new__(ReferenceDrive)
+            reference.files = list(items)
+            seconds, reference_names = resolve(reference)
+            if reference_names != names:
+                sys.exit("Paths or names differ from the earlier code at {} items".format(n))
+            earlier = "{:.3f}".format(seconds)
+        print("{:>10} {:>12.3f} {:>12} {:>14.2f}".format(n, current, earlier, current * 1e6 / n))
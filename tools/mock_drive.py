@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+__author__ = 'aurcioli'
+# Local mock of the parts of the Google Drive v2 API an acquisition uses: files, about, changes and
+# file content. Run it with a project folder, it points the google_drive project in it at the mock:
+#
+#   python3 tools/mock_drive.py /tmp/mockproject
+#   python3 searchgiant.py /tmp/mockproject google_drive
+#   curl http://127.0.0.1:8089/mock/change
+#   python3 searchgiant.py /tmp/mockproject google_drive --incremental
+#
+# Every GET of /mock/change modifies one file, adds one and deletes one, and records each as a change
+# the incremental acquisition gets from /changes.
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import threading
+import urllib.parse
+
+PAGE_SIZE = 25
+CHANGES_PAGE_SIZE = 10
+FIRST_CHANGE_ID = 1000
+
+
+class Drive:
+    # Items of the drive and the changes made to it since the mock started
+
+    def __init__(self, base_url, count):
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.items = {}
+        self.content = {}
+        self.changes = []
+        self.add_item(self.new_item('folder0', 'Documents', 'application/vnd.google-apps.folder', 'root'))
+        self.add_item(self.new_item('folder1', 'Reports', 'application/vnd.google-apps.folder', 'folder0'))
+        for i in range(count):
+            self.set_content(self.add_item(self.new_item('file{}'.format(i), 'file{}.txt'.format(i), 'text/plain', 'folder{}'.format(i % 2))),
+                             'Contents of file {}\n'.format(i).encode() * (i + 1))
+
+    def new_item(self, f_id, title, mime_type, parent):
+        return {'id': f_id, 'title': title, 'mimeType': mime_type, 'version': '1',
+                'parents': [{'id': parent, 'isRoot': parent == 'root'}],
+                'labels': {'trashed': False, 'restricted': False, 'hidden': False, 'starred': False, 'viewed': False}}
+
+    def add_item(self, item):
+        self.items[item['id']] = item
+        return item
+
+    def set_content(self, item, data):
+        self.content[item['id']] = data
+        item['fileSize'] = str(len(data))
+        item['md5Checksum'] = hashlib.md5(data).hexdigest()
+        item['downloadUrl'] = "{}/content/{}".format(self.base_url, item['id'])
+
+    def largest_change_id(self):
+        return FIRST_CHANGE_ID + len(self.changes)
+
+    def record(self, f_id, item=None):
+        change = {'id': str(self.largest_change_id() + 1), 'fileId': f_id, 'deleted': item is None}
+        if item is not None:
+            change['file'] = dict(item)
+        self.changes.append(change)
+
+    def change(self):
+        # One modified, one added and one deleted file
+        with self.lock:
+            n = len(self.changes)
+            files = sorted(f_id for f_id, item in self.items.items() if f_id in self.content)
+            modified = self.items[files[0]]
+            modified['version'] = str(int(modified['version']) + 1)
+            self.set_content(modified, "Changed in change {}\n".format(n).encode())
+            self.record(modified['id'], modified)
+            added = self.add_item(self.new_item('added{}'.format(n), 'added{}.txt'.format(n), 'text/plain', 'folder1'))
+            self.set_content(added, "Added in change {}\n".format(n).encode())
+            self.record(added['id'], added)
+            deleted = files[-1]
+            del self.items[deleted]
+            del self.content[deleted]
+            self.record(deleted)
+            return self.changes[-3:]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    drive = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        drive = self.drive
+        with drive.lock:
+            if url.path == '/drive/v2/files':
+                items = sorted(drive.items.values(), key=lambda item: item['id'])
+                return self.send(200, self.page(items, query, PAGE_SIZE, "/drive/v2/files?maxResults=0"))
+            if url.path == '/drive/v2/about':
+                return self.send(200, {'largestChangeId': str(drive.largest_change_id())})
+            if url.path == '/drive/v2/changes':
+                start = int(query.get('startChangeId', 0))
+                changes = [c for c in drive.changes if int(c['id']) >= start]
+                response = self.page(changes, query, CHANGES_PAGE_SIZE, "/drive/v2/changes?startChangeId={}".format(start))
+                response['largestChangeId'] = str(drive.largest_change_id())
+                return self.send(200, response)
+            if url.path.startswith('/content/'):
+                return self.send_content(url.path[len('/content/'):])
+        if url.path == '/mock/change':
+            return self.send(200, {'items': drive.change()})
+        self.send(404, {'error': {'code': 404, 'message': 'Not Found'}})
+
+    def page(self, items, query, size, link):
+        start = int(query.get('pageToken', 0))
+        response = {'items': items[start:start + size]}
+        if start + size < len(items):
+            response['nextPageToken'] = str(start + size)
+            response['nextLink'] = "{}{}&pageToken={}".format(self.drive.base_url, link, start + size)
+        return response
+
+    def send_content(self, f_id):
+        data = self.drive.content.get(f_id)
+        if data is None:
+            return self.send(404, {'error': {'code': 404, 'message': 'File not found'}})
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+        ranges = self.headers.get('Range')
+        if ranges and self.headers.get('If-Range', etag) == etag:
+            start, end = ranges.split('=', 1)[1].split('-')
+            start, end = int(start), int(end) if end else len(data) - 1
+            if start >= len(data):
+                return self.send(416, {'error': {'code': 416, 'message': 'Requested range not satisfiable'}})
+            headers['Content-Range'] = "bytes {}-{}/{}".format(start, end, len(data))
+            return self.send(206, data[start:end + 1], 'application/octet-stream', headers)
+        self.send(200, data, 'application/octet-stream', headers)
+
+
+def configure_project(project_dir, base_url):
+    # The google_drive project in project_dir uses the mock and a token it accepts
+    working_dir = os.path.join(project_dir, "google_drive")
+    config_file = os.path.join(working_dir, "config.json")
+    os.makedirs(working_dir, exist_ok=True)
+    config = {}
+    if os.path.isfile(config_file):
+        with open(config_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    config.update({"API_ENDPOINT": base_url + "/drive/v2", "CLIENT_ID": "mock", "CLIENT_SECRET": "mock",
+                   "OAUTH": {"access_token": "mock", "refresh_token": "mock"},
+                   "OAUTH_SCOPE": "https://www.googleapis.com/auth/drive.readonly"})
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump(config, f, sort_keys=True, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local mock of the Google Drive API")
+    parser.add_argument('project_dir', metavar='project_dir', type=str, nargs='?',
+                        help="Project folder whose google_drive project is pointed at the mock")
+    parser.add_argument('--port', metavar='port', type=int, help="Port to listen on. Default value is: 8089", default=8089)
+    parser.add_argument('--files', metavar='files', type=int, help="Files in the drive. Default value is: 20", default=20)
+    args = parser.parse_args()
+
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    Handler.drive = Drive(base_url, args.files)
+    if args.project_dir:
+        configure_project(args.project_dir, base_url)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print("Mock Google Drive API on {}/drive/v2".format(base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+__author__ = 'aurcioli'
+# Local mock of the GMail v1 API with its multipart/mixed batch endpoint. Run it with a project
+# folder, it points the gmail project in it at the mock:
+#
+#   python3 tools/mock_gmail_batch.py /tmp/mockproject --throttle-every 7
+#   python3 searchgiant.py /tmp/mockproject gmail
+#
+# Parts of a batch can be answered with 429 (--throttle-every) or 503 (--fail-every) to see them
+# being asked for again. With --check it tests gmail/Batch.py against itself and exits: responses
+# have to be split up by parse_response, and failed or throttled parts have to be left in the
+# BatchSlip for the next attempt while every other part is stored exactly once.
+
+import argparse
+import base64
+import http.client
+import http.server
+import io
+import json
+import os
+import re
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downloader import Downloader
+from gmail import Batch
+
+PAGE_SIZE = 10
+FIRST_HISTORY_ID = 1000
+BOUNDARY = "batch_mock_response"
+
+
+class Mailbox:
+    # Threads and messages of the mailbox, and history records of what was added since it started
+
+    def __init__(self, count):
+        self.lock = threading.Lock()
+        self.threads = []
+        self.messages = {}
+        self.history = []
+        self.history_id = FIRST_HISTORY_ID
+        for t in range(count):
+            thread = {'id': 'thread{}'.format(t), 'snippet': 'Thread {}'.format(t), 'historyId': str(self.history_id), 'messages': []}
+            self.threads.append(thread)
+            for m in range(1 + t % 3):
+                self.add_message(thread, ['INBOX'] + (['IMPORTANT'] if m % 2 else []))
+
+    def add_message(self, thread, labels):
+        m_id = "{}-{}".format(thread['id'], len(thread['messages']))
+        raw = ("From: sender@example.com\r\nTo: custodian@example.com\r\nSubject: Message {id}\r\n"
+               "Date: Mon, 1 Jan 2018 00:00:00 +0000\r\n\r\nBody of message {id}\r\n").format(id=m_id).encode()
+        message = {'id': m_id, 'threadId': thread['id'], 'labelIds': labels, 'snippet': 'Body of message ' + m_id,
+                   'historyId': str(self.history_id), 'internalDate': '1514764800000', 'sizeEstimate': len(raw),
+                   'raw': base64.urlsafe_b64encode(raw).decode('ascii'),
+                   'payload': {'headers': [{'name': 'From', 'value': 'sender@example.com'},
+                                           {'name': 'To', 'value': 'custodian@example.com'},
+                                           {'name': 'Subject', 'value': 'Message ' + m_id}]}}
+        self.messages[m_id] = message
+        thread['messages'].append(m_id)
+        return message
+
+    def change(self):
+        # A new thread with one message, recorded in the history
+        with self.lock:
+            thread = {'id': 'thread{}'.format(len(self.threads)), 'snippet': 'Added thread', 'messages': []}
+            self.threads.append(thread)
+            message = self.add_message(thread, ['INBOX'])
+            self.history_id += 1
+            thread['historyId'] = str(self.history_id)
+            self.history.append({'id': str(self.history_id), 'messagesAdded': [
+                {'message': {'id': message['id'], 'threadId': thread['id'], 'labelIds': message['labelIds']}}]})
+            return self.history[-1]
+
+    def get(self, path, query):
+        # (status, body) of a GET of path under /gmail/v1
+        with self.lock:
+            if path == '/users/me/profile':
+                return 200, {'emailAddress': 'custodian@example.com', 'historyId': str(self.history_id)}
+            if path == '/users/me/threads':
+                return 200, self.page('threads', [{'id': t['id'], 'snippet': t['snippet'], 'historyId': t['historyId']} for t in self.threads],
+                                      query, PAGE_SIZE)
+            if path.startswith('/users/me/threads/'):
+                thread = next((t for t in self.threads if t['id'] == path.rsplit('/', 1)[1]), None)
+                if thread is None:
+                    return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+                messages = [self.message(m_id, query.get('format')) for m_id in thread['messages']]
+                return 200, {'id': thread['id'], 'historyId': thread['historyId'], 'messages': messages}
+            if path == '/users/me/messages':
+                listed = [{'id': m['id'], 'threadId': m['threadId']} for m in self.messages.values()]
+                return 200, self.page('messages', listed, query, int(query.get('maxResults', PAGE_SIZE)))
+            if path.startswith('/users/me/messages/'):
+                m_id = path.rsplit('/', 1)[1]
+                if m_id not in self.messages:
+                    return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+                return 200, self.message(m_id, query.get('format'))
+            if path == '/users/me/history':
+                records = [r for r in self.history if int(r['id']) > int(query.get('startHistoryId', 0))]
+                response = self.page('history', records, query, PAGE_SIZE)
+                response['historyId'] = str(self.history_id)
+                return 200, response
+        return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+    def message(self, m_id, format):
+        message = dict(self.messages[m_id])
+        if format == 'raw':
+            del message['payload']
+        else:
+            del message['raw']
+            if format == 'minimal':
+                del message['payload']
+        return message
+
+    def page(self, key, items, query, size):
+        start = int(query.get('pageToken', 0))
+        response = {key: items[start:start + size]}
+        if start + size < len(items):
+            response['nextPageToken'] = str(start + size)
+        return response
+
+
+def batch_requests(body, content_type):
+    # (content id, method, path) of each request of a multipart/mixed batch
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    requests = []
+    for part in body.split(b'--' + boundary)[1:]:
+        if part.startswith(b'--'):
+            break
+        head, request = re.split(rb'\r?\n\r?\n', part.lstrip(b'\r\n'), 1)
+        content_id = re.search(rb'^Content-ID:\s*<([^>]*)>', head, re.MULTILINE | re.IGNORECASE)
+        method, path = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ')[:2]
+        requests.append((content_id.group(1).decode('latin-1') if content_id else None, method, path))
+    return requests
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mailbox = None
+    throttle_every = 0
+    fail_every = 0
+    parts = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/mock/change':
+            return self.send(200, self.mailbox.change())
+        if not url.path.startswith('/gmail/v1/'):
+            return self.send(404, {'error': {'code': 404, 'message': 'Not Found'}})
+        status, body = self.mailbox.get(url.path[len('/gmail/v1'):], dict(urllib.parse.parse_qsl(url.query)))
+        self.send(status, body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if urllib.parse.urlsplit(self.path).path != '/batch/gmail/v1':
+            return self.send(404, {'error': {'code': 404, 'message': 'Not Found'}})
+        requests = batch_requests(body, self.headers.get('Content-Type', ''))
+        if len(requests) > Batch.MAX_BATCH_SIZE:
+            return self.send(400, {'error': {'code': 400, 'message': 'Too many requests in a batch'}})
+        out = io.BytesIO()
+        for content_id, method, path in requests:
+            status, headers, data = self.answer(method, path)
+            out.write("--{}\r\nContent-Type: application/http\r\n".format(BOUNDARY).encode())
+            if content_id:
+                out.write("Content-ID: <response-{}>\r\n".format(content_id).encode())
+            out.write("\r\nHTTP/1.1 {} {}\r\n".format(status, http.client.responses.get(status, "")).encode())
+            for name, value in headers.items():
+                out.write("{}: {}\r\n".format(name, value).encode())
+            out.write("Content-Length: {}\r\n\r\n".format(len(data)).encode() + data + b"\r\n")
+        out.write("--{}--\r\n".format(BOUNDARY).encode())
+        self.send(200, out.getvalue(), "multipart/mixed; boundary=" + BOUNDARY)
+
+    def answer(self, method, path):
+        with Handler.lock:
+            Handler.parts += 1
+            count = Handler.parts
+        if self.throttle_every and count % self.throttle_every == 0:
+            return 429, {'Content-Type': 'application/json', 'Retry-After': '0'}, b'{"error": {"code": 429, "message": "Rate Limit Exceeded"}}'
+        if self.fail_every and count % self.fail_every == 0:
+            return 503, {'Content-Type': 'application/json'}, b'{"error": {"code": 503, "message": "Backend Error"}}'
+        url = urllib.parse.urlsplit(path)
+        if method != 'GET' or not url.path.startswith('/gmail/v1/'):
+            return 404, {'Content-Type': 'application/json'}, b'{"error": {"code": 404, "message": "Not Found"}}'
+        status, body = self.mailbox.get(url.path[len('/gmail/v1'):], dict(urllib.parse.parse_qsl(url.query)))
+        return status, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(body).encode()
+
+
+def configure_project(project_dir, base_url):
+    # The gmail project in project_dir uses the mock and a token it accepts
+    working_dir = os.path.join(project_dir, "gmail")
+    config_file = os.path.join(working_dir, "config.json")
+    os.makedirs(working_dir, exist_ok=True)
+    config = {}
+    if os.path.isfile(config_file):
+        with open(config_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    config.update({"API_ENDPOINT": base_url + "/gmail/v1", "CLIENT_ID": "mock", "CLIENT_SECRET": "mock",
+                   "OAUTH": {"access_token": "mock", "refresh_token": "mock"},
+                   "OAUTH_SCOPE": "https://www.googleapis.com/auth/gmail.readonly"})
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump(config, f, sort_keys=True, indent=4)
+
+
+class CheckProject:
+    # Just enough of a Project for a Batcher
+    def __init__(self):
+        self.logged = []
+
+    def log(self, type, message, level="info", stdout=False):
+        self.logged.append(message)
+
+
+def post_batch(slip):
+    request = urllib.request.Request(slip.url, slip.data.encode('utf-8'), {'Content-Type': slip.content_type})
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def check(base_url, mailbox):
+    api = base_url + "/gmail/v1"
+    m_ids = sorted(mailbox.messages)[:12]
+    slips = [Downloader.DownloadSlip("{}/users/me/messages/{}?format=raw".format(api, m_id), {'id': m_id}, m_id + ".txt", 'id')
+             for m_id in m_ids]
+    slips.append(Downloader.DownloadSlip(api + "/users/me/messages/missing?format=raw", {'id': 'missing'}, "missing.txt", 'id'))
+    batch = Batch.BatchSlip(Batch.batch_url(api), slips)
+
+    # Every part comes back under the Content-ID it was sent with
+    Handler.throttle_every, Handler.fail_every, Handler.parts = 0, 0, 0
+    parts = Batch.parse_response(post_batch(batch))
+    assert sorted(parts) == sorted("item{}".format(i) for i in range(len(slips))), sorted(parts)
+    for i, m_id in enumerate(m_ids):
+        status, reason, headers, body = parts["item{}".format(i)]
+        assert status == 200 and json.loads(body)['id'] == m_id, (status, body)
+    assert parts["item{}".format(len(m_ids))][0] == 404
+    print("parse_response: {} parts split up".format(len(parts)))
+
+    stored = []
+    project = CheckProject()
+    batcher = Batch.Batcher(project, batch.url)
+
+    def store(data, slip):
+        stored.append(json.loads(data.read().decode('utf-8'))['id'])
+
+    # Throttled parts are left in the slip and raised as a rate limit error
+    Handler.throttle_every, Handler.fail_every, Handler.parts = 4, 0, 0
+    try:
+        batcher.storage_callback(store)(io.BytesIO(post_batch(batch)), batch)
+        raise AssertionError("throttled parts were not raised")
+    except urllib.error.HTTPError as err:
+        assert err.code == 429, err
+    throttled = [m_ids[i] for i in (3, 7, 11)]
+    assert [s.item['id'] for s in batch.slips] == throttled, [s.item['id'] for s in batch.slips]
+    assert any("missing" in message for message in project.logged), project.logged
+    print("throttled: {} parts requeued, {} stored".format(len(batch.slips), len(stored)))
+
+    # Failed parts are left in the slip and raised as BatchFailed
+    Handler.throttle_every, Handler.fail_every, Handler.parts = 0, 2, 0
+    try:
+        batcher.storage_callback(store)(io.BytesIO(post_batch(batch)), batch)
+        raise AssertionError("failed parts were not raised")
+    except Batch.BatchFailed:
+        pass
+    assert [s.item['id'] for s in batch.slips] == [throttled[1]], [s.item['id'] for s in batch.slips]
+    print("failed: {} part requeued".format(len(batch.slips)))
+
+    # What is left goes through on the next attempt, every message was stored once
+    Handler.throttle_every, Handler.fail_every, Handler.parts = 0, 0, 0
+    batcher.storage_callback(store)(io.BytesIO(post_batch(batch)), batch)
+    assert sorted(stored) == m_ids, sorted(stored)
+    print("retried: all {} messages stored once".format(len(stored)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local mock of the GMail API and its batch endpoint")
+    parser.add_argument('project_dir', metavar='project_dir', type=str, nargs='?',
+                        help="Project folder whose gmail project is pointed at the mock")
+    parser.add_argument('--port', metavar='port', type=int, help="Port to listen on, 0 picks a free one. Default value is: 8090", default=8090)
+    parser.add_argument('--threads', metavar='threads', type=int, help="Threads in the mailbox. Default value is: 20", default=20)
+    parser.add_argument('--throttle-every', metavar='parts', type=int, help="Answer every nth batch part with 429", default=0)
+    parser.add_argument('--fail-every', metavar='parts', type=int, help="Answer every nth batch part with 503", default=0)
+    parser.add_argument('--check', help="Test gmail/Batch.py against the mock and exit", action="store_true")
+    args = parser.parse_args()
+
+    Handler.mailbox = Mailbox(args.threads)
+    Handler.throttle_every = args.throttle_every
+    Handler.fail_every = args.fail_every
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0 if args.check else args.port), Handler)
+    base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+    if args.check:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        check(base_url, Handler.mailbox)
+        server.shutdown()
+        sys.exit(0)
+    if args.project_dir:
+        configure_project(args.project_dir, base_url)
+    print("Mock GMail API on {}/gmail/v1, batch endpoint {}".format(base_url, Batch.batch_url(base_url + "/gmail/v1")))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
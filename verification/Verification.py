@@ -0,0 +1,86 @@
+__author__ = 'aurcioli'
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from common import Common
+
+
+class Verifier:
+    # Hashes acquired files on a pool of threads and writes the verification CSV as results come
+    # in. Items are dicts with 'remote_file', 'local_file' and optionally 'remote_hash'. Right after
+    # an acquisition the digests the manifest recorded while the files were written are compared
+    # and the files aren't read. With reread (see --verify-only) every file is read again and
+    # compared to those digests as well.
+
+    columns = "TIME_PROCESSED,REMOTE_FILE,LOCAL_FILE,REMOTE_HASH,LOCAL_HASH,MATCH,LOCAL_SHA1,LOCAL_SHA256\n"
+
+    def __init__(self, project, workers=None, reread=False):
+        self.project = project
+        self.reread = reread
+        self.workers = workers or os.cpu_count() or 4
+
+    def verify(self, items, verification_file):
+        errors = 0
+        tot_hashes = 0
+
+        # Biggest files first so nobody is left hashing a huge file alone at the end
+        work = []
+        for item in items:
+            lf = item['local_file']
+            size = os.path.getsize(lf) if os.path.isfile(lf) else -1
+            work.append((size, item))
+        work.sort(key=lambda w: w[0], reverse=True)
+
+        with open(verification_file, 'w') as f, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            f.write(self.columns)
+            futures = {executor.submit(self._digests, item['local_file'], size): item for size, item in work}
+            for future in as_completed(futures):
+                item = futures[future]
+                lf = item['local_file']
+                rf = item['remote_file']
+                try:
+                    digests, changed = future.result()
+                except OSError as err:
+                    self.project.log("exception", "Could not hash local file {} - {}".format(lf, err), "critical", True)
+                    digests, changed = None, None
+
+                lh = "FILE NOT FOUND" if digests is None else digests['md5']
+                if 'remote_hash' in item:
+                    tot_hashes += 1
+                    rh = item['remote_hash']
+                    if lh == rh:
+                        match = "YES"
+                    else:
+                        match = "NO"
+                        errors += 1
+                        self.project.log("exception", "Verification failed for remote file {} and local file {}".format(rf, lf), "critical", True)
+                else:
+                    rh = "NONE PROVIDED"
+                    match = "N/A"
+                # The file also has to still be what was written when it was acquired
+                if changed is not None and match != "NO":
+                    if match == "N/A":
+                        tot_hashes += 1
+                        match = "YES"
+                    if changed:
+                        match = "NO"
+                        errors += 1
+                        self.project.log("exception", "Local file {} changed since it was acquired".format(lf), "critical", True)
+                f.write('"{date}","{rf}","{lf}","{rh}","{lh}","{m}","{sha1}","{sha256}"\n'.format(
+                    date=Common.utc_get_datetime_as_string(), rf=rf, lf=lf, rh=rh, lh=lh, m=match,
+                    sha1='' if digests is None else digests.get('sha1', ''),
+                    sha256='' if digests is None else digests.get('sha256', '')))
+                f.flush()
+        return tot_hashes, errors
+
+    def _digests(self, path, size):
+        # (digests, True if the file changed since it was acquired). Whether it changed is None
+        # when no digests were recorded for it.
+        if size < 0:
+            return None, None
+        stored = self.project.get_digests(path)
+        if not self.reread and stored:
+            # Size and modification time tell if it was touched since the digests were taken
+            return stored, self.project.manifest.digests(path) is None
+        digests = Common.hashfile_multi(path)
+        return digests, None if not stored else stored['md5'] != digests['md5']